@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Coffee leaf rust model - reusable parts of the model scripts
+"""
+
+import importlib
+
+# public names and their modules, imported on first use so that a worker process or a
+# short command line job does not pay for numpy/pandas/scipy it never touches
+_exports = {
+    'clr.params': ['Params'],
+    'clr.varieties': ['Variety', 'VarietyTable', 'varieties'],
+    'clr.streams': ['Streams'],
+    'clr.engine': ['Plantation', 'run', 'group_frame', 'peak_infected'],
+    'clr.tauleap': ['run_tau', 'leap_error'],
+    'clr.partition': ['run_partitioned'],
+    'clr.snapshot': ['SnapshotWriter', 'SnapshotReader'],
+    'clr.store': ['ResultStore'],
+    'clr.meanfield': ['run_meanfield', 'validate_meanfield'],
+    'clr.runner': ['simulate', 'engines'],
+    'clr.cache': ['RunCache', 'run_key'],
+    'clr.ensemble': ['run_ensemble', 'map_runs'],
+    'clr.calibrate': ['abc_smc', 'observed_summary'],
+    'clr.sensitivity': ['sobol', 'saltelli'],
+    'clr.interventions': ['Spray', 'Prune', 'Harvest', 'run_schedule', 'evaluate_schedules'],
+    'clr.eventlog': ['TransitionLog'],
+    'clr.memory': ['projected_memory', 'plan'],
+    'clr.equivalence': ['equivalence', 'run_reference'],
+}
+_where = {name: module for module, names in _exports.items() for name in names}
+
+__all__ = list(_where)
+
+
+def __getattr__(name):
+    module = _where.get(name)
+    if module is None:
+        raise AttributeError("module 'clr' has no attribute %r" % name)
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from clr.cli import main
+
+main()
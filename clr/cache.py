@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import secrets
+from dataclasses import asdict
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.streams import Streams
+from clr.varieties import varieties
+
+
+# default size budget of a cache folder (bytes)
+cache_budget = 1 << 30
+
+# options that do not change the results of a run
+unkeyed_options = {'workers', 'tiles', 'compact'}
+
+
+def run_key(params, seed, days, engine, replicate=0, options=None):
+    """
+    Canonical hash of everything that decides a run's output: all Params fields, the variety
+    definitions of the mixture, the seed, replicate, days, engine name and engine version and the
+    engine options. Returns None if the run cannot be repeated (no seed), an option has no
+    canonical form (e.g. a monitor callback) or the run returns more than its data frame (state).
+    """
+    from clr.runner import engine_versions
+    if seed is None or (options or {}).get('state'):
+        return None
+    if isinstance(seed, Streams):
+        seed, replicate = seed.seed, seed.replicate
+    kept = {k: v for k, v in (options or {}).items() if k not in unkeyed_options}
+    content = {'params': asdict(params), 'varieties': {v: asdict(varieties[v]) for v in sorted(params.mixture)
+                                                         if v in varieties},
+               'seed': int(seed), 'replicate': int(replicate), 'days': int(days),
+               'engine': engine, 'version': engine_versions[engine], 'options': kept}
+    try:
+        text = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    except TypeError:
+        return None
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class RunCache:
+    """
+    Content-addressed cache of run outputs on disk. Each run's data frame is one compressed file
+    named by run_key(). Reading a file marks it as recently used, and whenever the folder grows
+    beyond budget bytes the least recently used files are removed.
+    """
+
+    def __init__(self, path, budget=cache_budget):
+        self.path = path
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        """
+        cached data frame of a key, or None
+        """
+        fpath = self._file(key)
+        try:
+            with np.load(fpath, allow_pickle=False) as f:
+                order = [str(c) for c in f['__columns__']]
+                df = pd.DataFrame({c: f[c] for c in order})
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        os.utime(fpath)
+        return df
+
+    def put(self, key, df):
+        columns = {c: df[c].to_numpy() for c in df.columns}
+        columns = {c: v.astype(str) if v.dtype == object else v for c, v in columns.items()}
+        # write to a temporary file first so readers never see half a file
+        tmp = os.path.join(self.path, '.%s.%s.npz' % (key, secrets.token_hex(4)))
+        np.savez_compressed(tmp, __columns__=np.array(list(df.columns), dtype=str), **columns)
+        os.replace(tmp, self._file(key))
+        self.evict()
+
+    def run(self, params=None, seed=None, days=None, engine='leaf', replicate=0, **options):
+        """
+        simulate() through the cache
+        """
+        from clr.runner import simulate
+        params = Params() if params is None else params
+        days = params.days if days is None else days
+        key = run_key(params, seed, days, engine, replicate, options)
+        if key is not None:
+            df = self.get(key)
+            if df is not None:
+                self.hits += 1
+                return df
+        self.misses += 1
+        df = simulate(params, seed, days, engine, replicate, **options)
+        if key is not None and isinstance(df, pd.DataFrame):
+            self.put(key, df)
+        return df
+
+    def entries(self):
+        """
+        (last used, size, path) of the cached runs, oldest first
+        """
+        out = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz') and not name.startswith('.'):
+                fpath = os.path.join(self.path, name)
+                try:
+                    st = os.stat(fpath)
+                except FileNotFoundError:
+                    continue
+                out.append((st.st_mtime, st.st_size, fpath))
+        return sorted(out)
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self, budget=None):
+        """
+        remove least recently used runs until the cache fits the budget
+        """
+        budget = self.budget if budget is None else budget
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for _, size, fpath in entries:
+            if total <= budget:
+                break
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(0)
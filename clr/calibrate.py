@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.streams import PROPOSAL, as_streams
+from clr.ensemble import map_runs
+
+
+# priors of the calibrated constants: (scale, low, high), 'log' priors are uniform in log10
+priors = {
+    'clr_b': ('log', 1e-4, 1e-2),
+    'clr_p': ('log', 1e-5, 1e-3),
+    'clr_g': ('log', 1e-6, 1e-4),
+    'germ_chance': ('linear', 0.05, 1.0),
+    'benchmark_1': ('int', 10, 60),
+    'benchmark_2': ('int', 60, 200),
+    'benchmark_3': ('int', 100, 250),
+}
+
+
+def observed_summary(df, params=None):
+    """
+    Summary statistics of infected leaves per branch over time, from a frame with the
+    columns of make_frame_branches() (time, infected and optionally grid, one row per
+    observed branch and day): the mean per observation day and grid cell.
+    Grid cells given as (x, y) tuples, as make_frame_branches() reports them, get the labels
+    of the simulated frames (params.cell_label).
+    Returns a series indexed by (grid, time), grid 'all' if the data has no grid column.
+    """
+    params = Params() if params is None else params
+    df = df.copy()
+    if 'grid' not in df.columns:
+        df['grid'] = 'all'
+    df['grid'] = [params.cell_label(tuple(int(v) for v in g)) if isinstance(g, tuple) else str(g)
+                  for g in df['grid']]
+    return df.groupby(['grid', 'time'])['infected'].mean().sort_index()
+
+
+class _Rejected(Exception):
+    pass
+
+
+class PartialDistance:
+    """
+    Plantation monitor computing the distance to the observed summaries as the run goes.
+    The distance is the root mean square of (simulated - observed) / scale over all observation
+    points, so the partial sum only grows and a run can be stopped as soon as it passes the
+    tolerance.
+    """
+
+    def __init__(self, observed, scale, tolerance=np.inf):
+        self.observed = observed
+        self.scale = scale
+        self.tolerance = tolerance
+        self.total = len(observed)
+        self.times = np.unique(observed.index.get_level_values('time'))
+        self.next = 0
+        self.sum = 0.0
+
+    def distance(self):
+        return np.sqrt(self.sum / max(self.total, 1))
+
+    def add(self, t, labels, values):
+        """
+        add the simulated values of day t for the grid labels, raises _Rejected past the tolerance
+        """
+        for label, value in zip(labels, values):
+            if (label, t) in self.observed.index:
+                obs = self.observed[(label, t)]
+                self.sum += ((value - obs) / self.scale[(label, t)]) ** 2
+        if self.distance() > self.tolerance:
+            raise _Rejected()
+
+    def __call__(self, plantation, time):
+        # engines that skip days (tau-leaping) report at the first day past an observation day
+        while self.next < len(self.times) and self.times[self.next] <= time:
+            t = self.times[self.next]
+            self.next += 1
+            infected = plantation.summary()['infected']
+            grid = plantation.branches.grid
+            per_cell = np.bincount(grid, weights=infected, minlength=len(plantation.cells))
+            per_cell = per_cell / np.maximum(np.bincount(grid, minlength=len(plantation.cells)), 1)
+            labels = [plantation.params.cell_label(c) for c in plantation.cells]
+            self.add(t, labels + ['all'], list(per_cell) + [infected.mean()])
+
+    def score(self, df):
+        """
+        distance of a finished run from its branch level data frame, for engines without a
+        monitor (rows of the compartment model are cell means, 'all' is their mean)
+        """
+        df = df[df['time'].isin(self.times)]
+        per_cell = df.groupby(['time', 'grid'])['infected'].mean()
+        overall = df.groupby('time')['infected'].mean()
+        for t in self.times:
+            self.next += 1
+            cells = per_cell.xs(t, level='time')
+            self.add(t, list(cells.index) + ['all'], list(cells) + [overall[t]])
+
+
+def _simulate(task):
+    """
+    Distance of one particle, and the share of the days it was simulated for
+    """
+    from clr.runner import simulate
+    from clr.ensemble import _monitored
+    params, seed, replicate, engine, observed, scale, tolerance = task
+    days = int(observed.index.get_level_values('time').max()) + 1
+    monitor = PartialDistance(observed, scale, tolerance)
+    try:
+        if engine in _monitored:
+            simulate(params, seed, days, engine, replicate, monitor=monitor)
+        else:
+            monitor.score(simulate(params, seed, days, engine, replicate))
+    except _Rejected:
+        if engine not in _monitored:
+            return np.inf, 1.0
+        return np.inf, (monitor.times[monitor.next - 1] + 1) / days
+    return monitor.distance(), 1.0
+
+
+def _to_space(values, names, prior):
+    """
+    parameter values in the space the kernel works in (log10 for log priors)
+    """
+    return np.array([np.log10(values[k]) if prior[k][0] == 'log' else float(values[k]) for k in names])
+
+
+def _from_space(x, names, prior):
+    out = {}
+    for k, v in zip(names, x):
+        kind = prior[k][0]
+        out[k] = 10 ** v if kind == 'log' else int(round(v)) if kind == 'int' else float(v)
+    return out
+
+
+def _bounds(names, prior):
+    lo = np.array([np.log10(prior[k][1]) if prior[k][0] == 'log' else prior[k][1] for k in names], dtype=float)
+    hi = np.array([np.log10(prior[k][2]) if prior[k][0] == 'log' else prior[k][2] for k in names], dtype=float)
+    return lo, hi
+
+
+def _valid(values):
+    b = [values.get('benchmark_%d' % i) for i in (1, 2, 3)]
+    known = [x for x in b if x is not None]
+    return all(x < y for x, y in zip(known, known[1:]))
+
+
+def abc_smc(observed, params=None, prior=None, particles=100, generations=5, quantile=0.5, min_acceptance=0.01,
+            seed=None, engine='leaf', batch=None, workers=None):
+    """
+    Fit model constants to observed infected leaves per branch with ABC-SMC
+    (population Monte Carlo with an adaptive tolerance).
+    observed is a make_frame_branches() style frame or an observed_summary() series.
+    The first generation samples the prior, each later one perturbs weighted particles of the
+    previous one with a Gaussian kernel (twice their weighted covariance) and keeps those
+    within the tolerance, the quantile of the previous generation's distances. Candidates are
+    simulated in parallel batches and a simulation stops once its partial distance exceeds the
+    tolerance. Scales are relative, (simulated - observed) / max(observed, 1). Engines without a
+    monitor (meanfield, partitioned) are run to the last observation day and scored after.
+    Returns the final particles (parameter columns, weight, distance) and a per-generation
+    history (tolerance, simulations, acceptance rate, share of days simulated).
+    """
+    params = Params() if params is None else params
+    prior = priors if prior is None else prior
+    if not isinstance(observed, pd.Series):
+        observed = observed_summary(observed, params)
+    labels = set(params.cell_label(c) for c in params.cells()) | {'all'}
+    unknown = sorted(set(observed.index.get_level_values('grid')) - labels)
+    if unknown:
+        raise ValueError('observed grid cells %s are not cells of the simulated grid (%s)'
+                         % (', '.join(map(str, unknown)), ', '.join(sorted(labels))))
+    scale = np.maximum(observed.abs(), 1.0)
+    names = list(prior)
+    lo, hi = _bounds(names, prior)
+    streams = as_streams(seed)
+    rng = streams.generator(PROPOSAL)
+    batch = 2 * particles if batch is None else batch
+
+    history = []
+    replicate = 0
+    tolerance = np.inf
+    x = w = d = None
+    for generation in range(generations):
+        if x is not None:
+            cov = 2 * np.atleast_2d(np.cov(x.T, aweights=w))
+            if len(x) <= len(names):
+                # too few particles for a full covariance
+                cov = np.diag(np.diag(cov))
+            cov += 1e-6 * np.diag((hi - lo) ** 2)
+            chol = np.linalg.cholesky(cov)
+            inv = np.linalg.inv(cov)
+
+        def candidate():
+            while True:
+                if x is None:
+                    z = rng.uniform(lo, hi)
+                else:
+                    z = x[rng.choice(len(x), p=w)] + chol @ rng.standard_normal(len(names))
+                    if np.any(z < lo) or np.any(z > hi):
+                        continue
+                values = _from_space(z, names, prior)
+                if _valid(values):
+                    return _to_space(values, names, prior), values
+
+        accepted, distances, runs, work = [], [], 0, 0.0
+        while len(accepted) < particles:
+            # every prior sample is accepted in the first generation
+            size = particles - len(accepted) if x is None else batch
+            cands = [candidate() for _ in range(size)]
+            tasks = []
+            for _, values in cands:
+                tasks.append((params.update(**values), streams.seed, replicate, engine, observed, scale, tolerance))
+                replicate += 1
+            # the whole batch runs, then candidates are accepted in the order they were drawn,
+            # so the particles do not depend on which simulations finish first
+            results = dict(map_runs(tasks, fn=_simulate, workers=workers))
+            for n in sorted(results):
+                dist, share = results[n]
+                runs += 1
+                work += share
+                if dist <= tolerance and len(accepted) < particles:
+                    accepted.append(cands[n][0])
+                    distances.append(dist)
+            if runs >= particles / min_acceptance:
+                break
+        if len(accepted) < particles:
+            history.append({'generation': generation, 'tolerance': tolerance, 'runs': runs,
+                            'acceptance': len(accepted) / max(runs, 1), 'days_simulated': work / max(runs, 1)})
+            break
+
+        new_x = np.array(accepted)
+        if x is None:
+            new_w = np.ones(len(new_x))
+        else:
+            # prior density is flat in the kernel space, weights are 1 / sum_j w_j K(x | x_j)
+            diff = new_x[:, None, :] - x[None, :, :]
+            log_k = -0.5 * np.einsum('ijk,kl,ijl->ij', diff, inv, diff) + np.log(w)[None, :]
+            top = log_k.max(axis=1)
+            log_sum = top + np.log(np.exp(log_k - top[:, None]).sum(axis=1))
+            new_w = np.exp(log_sum.min() - log_sum)
+        x, w, d = new_x, new_w / new_w.sum(), np.array(distances)
+        history.append({'generation': generation, 'tolerance': tolerance, 'runs': runs,
+                        'acceptance': particles / runs, 'days_simulated': work / runs})
+        tolerance = float(np.quantile(d, quantile))
+
+    if x is None:
+        return pd.DataFrame(columns=names + ['weight', 'distance']), pd.DataFrame(history)
+    out = pd.DataFrame([_from_space(z, names, prior) for z in x])
+    out['weight'] = w
+    out['distance'] = d
+    return out, pd.DataFrame(history)
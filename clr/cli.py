@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Command line entry point: python -m clr run|ensemble|sweep|bench|serve|check
+
+Only argparse and the parameter module are imported at start, numpy/pandas/scipy and the
+engines are imported inside the subcommand that needs them.
+"""
+
+import argparse
+import json
+import sys
+import time as timer
+
+from clr.params import Params, load_params, param_names, _coerce
+
+
+def _value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def _assignment(text):
+    if '=' not in text:
+        raise argparse.ArgumentTypeError('expected NAME=VALUE, got %r' % text)
+    name, value = text.split('=', 1)
+    if name not in param_names():
+        raise argparse.ArgumentTypeError('unknown parameter %r' % name)
+    return name, value
+
+
+def _params(args, base=None):
+    base = Params() if base is None else base
+    params = load_params(args.params, base) if args.params else base
+    changes = {name: _coerce(name, _value(value)) for name, value in args.set}
+    if args.days is not None:
+        changes['days'] = args.days
+    return params.update(**changes)
+
+
+def _options(args):
+    options = {}
+    if args.tiles is not None and args.engine == 'partitioned':
+        options['tiles'] = args.tiles
+    if getattr(args, 'compact', False) and args.engine in ('leaf', 'tau', 'partitioned'):
+        options['compact'] = True
+    return options
+
+
+def _write(df, path):
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+    else:
+        from clr.store import ResultStore
+        ResultStore(path).write(df)
+
+
+def cmd_run(args):
+    from clr.runner import simulate
+    from clr.engine import group_frame
+    params = _params(args)
+    cache = None
+    if args.cache:
+        from clr.cache import RunCache
+        cache = RunCache(args.cache)
+    budget = None if args.budget is None else int(args.budget * 2 ** 20)
+    start = timer.perf_counter()
+    df = simulate(params, args.seed, params.days, args.engine, args.replicate, cache=cache, budget=budget,
+                  **_options(args))
+    took = timer.perf_counter() - start
+    if args.out:
+        _write(df, args.out)
+    last = group_frame(df)
+    print(last[last['time'] == last['time'].max()].to_string(index=False))
+    print('%s run of %d days in %.2f s' % (df.attrs.get('engine', args.engine), params.days, took), file=sys.stderr)
+
+
+def cmd_ensemble(args):
+    from clr.ensemble import run_ensemble
+    params = _params(args)
+    outputs, report = run_ensemble(params, args.seed, params.days, args.engine, width=args.width,
+                                   relative=not args.absolute, confidence=args.confidence, min_runs=args.min_runs,
+                                   max_runs=args.max_runs, workers=args.workers, **_options(args))
+    if args.out:
+        outputs.to_csv(args.out, index=False)
+    print(report.to_string(index=False))
+
+
+def _sweep_task(task):
+    from clr.ensemble import run_task, targets
+    return targets(run_task(task))
+
+
+def cmd_sweep(args):
+    import itertools
+    import pandas as pd
+    from clr.ensemble import map_runs
+    from clr.streams import as_streams
+    params = _params(args)
+    names = [name for name, _ in args.vary]
+    grids = [[_coerce(name, _value(v)) for v in values.split(',')] for name, values in args.vary]
+    points = [dict(zip(names, combo)) for combo in itertools.product(*grids)]
+    seed = as_streams(args.seed).seed
+    keys = [(i, r) for i in range(len(points)) for r in range(args.replicates)]
+    tasks = [(params.update(**points[i]), seed, params.days, args.engine, r, _options(args), None) for i, r in keys]
+    rows = [dict(points[keys[n][0]], point=keys[n][0], replicate=keys[n][1], **result)
+            for n, result in map_runs(tasks, fn=_sweep_task, workers=args.workers)]
+    out = pd.DataFrame(rows).sort_values(['point', 'replicate']).reset_index(drop=True)
+    if args.out:
+        out.to_csv(args.out, index=False)
+    summary = out.drop(columns='replicate').groupby(['point'] + names, dropna=False).mean().reset_index()
+    print(summary.to_string(index=False))
+
+
+def cmd_bench(args):
+    import pandas as pd
+    from clr.runner import simulate
+    params = _params(args)
+    rows = []
+    for engine in args.engines.split(','):
+        times = []
+        for r in range(args.repeat):
+            start = timer.perf_counter()
+            df = simulate(params, args.seed, params.days, engine, r)
+            times.append(timer.perf_counter() - start)
+        rows.append({'engine': engine, 'days': params.days, 'cells': len(params.cells()), 'rows': len(df),
+                     'best_s': min(times), 'mean_s': sum(times) / len(times)})
+    out = pd.DataFrame(rows)
+    base = out.loc[out['engine'] == 'leaf', 'best_s']
+    if len(base):
+        out['speedup'] = float(base.iloc[0]) / out['best_s']
+    print(out.to_string(index=False))
+
+
+def cmd_check(args):
+    import pandas as pd
+    from clr.equivalence import equivalence, suites
+    reports, tests = [], []
+    for name in args.suite.split(','):
+        base, engines = suites[name]
+        engines = args.engines.split(',') if args.engines else engines
+        report, tested = equivalence(_params(args, base), runs=args.runs, seed=args.seed, engines=engines,
+                                     every=args.every, alpha=args.alpha, workers=args.workers)
+        reports.append(report.assign(suite=name))
+        tests.append(tested.assign(suite=name))
+    report = pd.concat(reports, ignore_index=True)
+    if args.out:
+        pd.concat(tests, ignore_index=True).to_csv(args.out, index=False)
+    print(report[['suite'] + [c for c in report.columns if c != 'suite']].to_string(index=False))
+    if not report['passed'].dropna().all():
+        sys.exit(1)
+
+
+def cmd_serve(args):
+    from clr.service import serve
+    print('serving on %s' % (args.socket or '%s:%d' % (args.host, args.port)), file=sys.stderr)
+    serve(args.host, args.port, args.socket, args.workers)
+
+
+def parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-p', '--params', help='parameter file (.json or .toml) of Params fields')
+    common.add_argument('--set', action='append', default=[], type=_assignment, metavar='NAME=VALUE',
+                        help='override a parameter (JSON value), can be repeated')
+    common.add_argument('--days', type=int)
+    common.add_argument('--seed', type=int, default=0)
+    common.add_argument('--engine', default='leaf', choices=['leaf', 'tau', 'partitioned', 'meanfield'])
+    common.add_argument('--compact', action='store_true', help='narrow leaf column types')
+    common.add_argument('--tiles', type=int, help='worker processes of one partitioned run')
+
+    ap = argparse.ArgumentParser(prog='clr', description='coffee leaf rust model')
+    sub = ap.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', parents=[common], help='one run, prints the last day per grid cell')
+    p.add_argument('--replicate', type=int, default=0)
+    p.add_argument('--out', help='.csv file or result store folder for the branch level data')
+    p.add_argument('--cache', help='run cache folder')
+    p.add_argument('--budget', type=float, help='memory budget (MB)')
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser('ensemble', parents=[common], help='replicates until the targets converge')
+    p.add_argument('--width', type=float, default=0.05)
+    p.add_argument('--absolute', action='store_true', help='width in output units, not relative to the mean')
+    p.add_argument('--confidence', type=float, default=0.95)
+    p.add_argument('--min-runs', type=int, default=10)
+    p.add_argument('--max-runs', type=int, default=500)
+    p.add_argument('--workers', type=int)
+    p.add_argument('--out', help='.csv file for the outputs of every replicate')
+    p.set_defaults(func=cmd_ensemble)
+
+    p = sub.add_parser('sweep', parents=[common], help='targets over a grid of parameter values')
+    p.add_argument('--vary', action='append', default=[], type=_assignment, metavar='NAME=V1,V2,...',
+                   required=True)
+    p.add_argument('--replicates', type=int, default=1)
+    p.add_argument('--workers', type=int)
+    p.add_argument('--out', help='.csv file for the targets of every run')
+    p.set_defaults(func=cmd_sweep)
+
+    p = sub.add_parser('bench', parents=[common], help='time the engines')
+    p.add_argument('--engines', default='leaf,tau,meanfield')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=cmd_bench)
+
+    p = sub.add_parser('check', help='compare engines with the reference model, exits 1 if one differs')
+    p.add_argument('-p', '--params', help='parameter file, fields not in it keep the suite\'s plantation')
+    p.add_argument('--set', action='append', default=[], type=_assignment, metavar='NAME=VALUE')
+    p.add_argument('--days', type=int)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--suite', default='fast,model',
+                   help='fast: spread 20x the model rates (leaf, tau), model: the model rates (tau)')
+    p.add_argument('--engines', help='engines to check in every suite')
+    p.add_argument('--runs', type=int, default=60)
+    p.add_argument('--every', type=int, default=20, help='compare every n-th day')
+    p.add_argument('--alpha', type=float, default=0.01)
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--out', help='.csv file for the tests')
+    p.set_defaults(func=cmd_check)
+
+    p = sub.add_parser('serve', help='job queue service with a warm worker pool (see clr/service.py)')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--socket', help='listen on a Unix socket instead')
+    p.add_argument('--workers', type=int, default=2)
+    p.set_defaults(func=cmd_serve)
+    return ap
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
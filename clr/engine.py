@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.streams import as_streams
+from clr.varieties import VarietyTable, param_columns, compact_param_columns
+
+
+# leaf status codes, as lstatus in model_2.2.py
+lstatus = {'healthy': 0, 'latent': 1, 'spores': 2, 'dead': 3}
+
+# columns of the leaf, branch and plant arrays
+# leaf plant/branch are row numbers in the plant/branch arrays, the branch and plant
+# arrays keep the per-plant and per-cell numbering of model_2.2.py
+leaf_columns = {'grid': np.int64, 'plant': np.int64, 'branch': np.int64, 'leaf': np.int64,
+                'age': np.int64, 'status': np.int64, 'prod': np.int64, 'idays': np.int64,
+                'clr_germs': np.int64, 'variety': np.int64}
+branch_columns = {'grid': np.int64, 'plant': np.int64, 'branch': np.int64, 'berries': np.int64,
+                  'leaf_prod': np.float64, 'berry_prod': np.float64, 'n_leaves': np.int64}
+plant_columns = {'grid': np.int64, 'plant': np.int64, 'variety': np.int64}
+
+# narrowest types that hold the leaf state, for plantations with millions of leaves (see clr/memory.py)
+compact_leaf_columns = {'grid': np.int32, 'plant': np.int32, 'branch': np.int32, 'leaf': np.int16,
+                        'age': np.int16, 'status': np.int8, 'prod': np.uint8, 'idays': np.int16,
+                        'clr_germs': np.int32, 'variety': np.int8}
+
+
+class Table:
+    """
+    Columns of equal length with spare capacity at the end, so that appending the
+    few new leaves of a day does not copy every column. Columns are read as attributes
+    and are views on the filled part. alloc decides where the column memory lives
+    (process memory by default, see clr/shared.py for shared memory).
+    """
+
+    def __init__(self, dtypes, n=0, capacity=0, alloc=None):
+        self.dtypes = dict(dtypes)
+        self.alloc = local_alloc if alloc is None else alloc
+        self.n = n
+        self.capacity = max(capacity, n, 16)
+        self.data = {}
+        for c, d in self.dtypes.items():
+            self.data[c] = self.alloc.zeros(self.capacity, d)
+
+    def __getattr__(self, name):
+        data = self.__dict__.get('data')
+        if data is not None and name in data:
+            return data[name][:self.n]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.n
+
+    def reserve(self, size):
+        if size <= self.capacity:
+            return
+        capacity = max(size, 2 * self.capacity)
+        for c, old in self.data.items():
+            new = self.alloc.zeros(capacity, old.dtype)
+            new[:self.n] = old[:self.n]
+            self.data[c] = new
+            self.alloc.free(old)
+        self.capacity = capacity
+
+    def append(self, **columns):
+        k = len(next(iter(columns.values())))
+        self.reserve(self.n + k)
+        for c, values in columns.items():
+            self.data[c][self.n:self.n + k] = values
+        self.n += k
+
+    def set(self, **columns):
+        """
+        fill the table from whole columns
+        """
+        self.n = 0
+        self.append(**columns)
+
+    def free(self):
+        for a in self.data.values():
+            self.alloc.free(a)
+        self.data = {}
+        self.n = self.capacity = 0
+
+
+class LocalAlloc:
+    """
+    column memory in the process, freed by the garbage collector
+    """
+
+    def zeros(self, size, dtype):
+        return np.zeros(size, dtype=dtype)
+
+    def free(self, array):
+        pass
+
+
+local_alloc = LocalAlloc()
+
+
+def _local_index(counts):
+    """
+    numbering that restarts at 0 for every group of the given sizes
+    """
+    total = counts.sum()
+    starts = np.cumsum(counts) - counts
+    return np.arange(total) - np.repeat(starts, counts)
+
+
+class Plantation:
+    """
+    The whole plantation held as arrays - one row per leaf, branch and plant.
+    A day runs the same steps as the Leaf/Branch/Plant/Grid loop of model_2.2.py,
+    each as one operation over all leaves instead of a method call per object.
+    Variety parameters are gathered into per-leaf arrays (lp) when leaves are created.
+    With compact=True the leaf columns use the narrowest types that hold them.
+    """
+
+    def __init__(self, params, varieties=None, cells=None, alloc=None, compact=False):
+        self.params = params
+        all_cells = params.cells()
+        self.cells = all_cells if cells is None else [tuple(c) for c in cells]
+        number = {c: i for i, c in enumerate(all_cells)}
+        # number of each cell in the whole grid, keys the random streams
+        self.cell_ids = np.array([number[c] for c in self.cells], dtype=np.int64)
+        self.varieties = VarietyTable(params, varieties)
+        self.leaves = Table(compact_leaf_columns if compact else leaf_columns, alloc=alloc)
+        self.lp = Table(compact_param_columns if compact else param_columns, alloc=alloc)
+        self.branches = Table(branch_columns, alloc=alloc)
+        self.plants = Table(plant_columns, alloc=alloc)
+        self.time = 0
+        self._day_streams = {}
+        # optional TransitionLog (see clr/eventlog.py)
+        self.log = None
+        # fungicide cover per grid cell, (efficacy, protected until day), set by Spray (clr/interventions.py)
+        self.protection = None
+
+    @classmethod
+    def build(cls, params, streams, varieties=None, cells=None, alloc=None, compact=False):
+        """
+        Random plantation layout, same distributions as model_2.2.py.
+        Each grid cell is laid out from its own stream (see clr/streams.py).
+        cells restricts the plantation to part of the grid (default: the whole grid).
+        """
+        p = params
+        self = cls(params, varieties, cells, alloc, compact)
+        plants, variety, branches, leaves, ages = [], [], [], [], []
+        for gid in self.cell_ids:
+            rng = streams.layout(gid)
+            n = rng.integers(p.plants_per_cell_min, p.plants_per_cell_max + 1)
+            plants.append(n)
+            variety.append(self.varieties.draw(rng, n))
+            branches.append(rng.integers(p.branches_per_plant_min, p.branches_per_plant_max + 1, n))
+            leaves.append(rng.integers(p.leaves_per_branch_min, p.leaves_per_branch_max + 1, branches[-1].sum()))
+            ages.append(rng.integers(p.age_min, p.age_max + 1, leaves[-1].sum()))
+        plants = np.array(plants, dtype=np.int64)
+        branches, leaves = np.concatenate(branches), np.concatenate(leaves)
+
+        plant_grid = np.repeat(np.arange(len(self.cells)), plants)
+        self.plants.set(grid=plant_grid, plant=_local_index(plants), variety=np.concatenate(variety))
+        branch_plant = np.repeat(np.arange(len(plant_grid)), branches)
+        self.branches.set(grid=plant_grid[branch_plant], plant=branch_plant, branch=_local_index(branches),
+                          berries=0, leaf_prod=0, berry_prod=0, n_leaves=leaves)
+        leaf_branch = np.repeat(np.arange(len(branch_plant)), leaves)
+        self.add_leaves(leaf_branch, leaf=_local_index(leaves), age=np.concatenate(ages), prod=10)
+        self.seed_infection()
+        return self
+
+    def add_leaves(self, branch, leaf, age, prod):
+        """
+        Append healthy leaves to the given branches, with their variety parameters
+        """
+        plant = self.branches.plant[branch]
+        variety = self.plants.variety[plant]
+        self.leaves.append(grid=self.branches.grid[branch], plant=plant, branch=branch, leaf=leaf,
+                           age=age, status=0, prod=prod, idays=0, clr_germs=0, variety=variety)
+        self.lp.append(**self.varieties.gather(variety))
+
+    def seed_infection(self):
+        """
+        Start off with infected leaves on one branch of the cells in params.infect_cells
+        """
+        p = self.params
+        cells = [self.cells.index(tuple(c)) for c in p.infect_cells if tuple(c) in self.cells]
+        L, B = self.leaves, self.branches
+        on_branch = (np.isin(B.grid, cells) & (self.plants.plant[B.plant] == p.infect_plant)
+                     & (B.branch == p.infect_branch))
+        hit = on_branch[L.branch] & np.isin(L.leaf, p.infect_leaves)
+        L.status[hit] = 1
+        L.idays[hit] = 1
+
+    def step(self, streams, exchange=None):
+        """
+        Advance the plantation by one day. Random draws come from the streams of each
+        grid cell for the day. exchange, if given, receives the latent leaves per grid cell
+        and returns the counts the grid level infection should use (see clr/partition.py).
+        """
+        self._day_streams = {}
+        self.aging()
+        self.clr_progression()
+        self.leaf_death()
+        plant_inf, grid_inf = self.latent_counts(exchange)
+        self.production_l()
+        self.production_b()
+        self.germ_rust(streams)
+        self.infection(streams, plant_inf, grid_inf)
+        self.time += 1
+        if self.log is not None:
+            self.log.record(self)
+
+    def aging(self):
+        """
+        leaves age by one day, their base productivity follows their age
+        """
+        p = self.params
+        L = self.leaves
+        status, age = L.status, L.age
+        alive = status < 3
+        age[alive] += 1
+        status[alive & (age > p.age_3)] = 3
+        a = age[alive]
+        L.prod[alive] = np.where(a > p.age_2, 7, np.where(a > p.age_1, 10, 5))
+
+    def clr_progression(self):
+        """
+        infections advance by one day and reduce leaf productivity
+        """
+        L, lp = self.leaves, self.lp
+        status, prod, idays = L.status, L.prod, L.idays
+        inf = (status == 1) | (status == 2)
+        idays[inf] += 1
+        b1 = inf & (idays < lp.benchmark_1)
+        b2 = inf & ~b1 & (idays < lp.benchmark_2)
+        b3 = inf & ~b1 & ~b2 & (idays < lp.benchmark_3)
+        # max(prod - x, 0) without going below zero in unsigned columns
+        prod[b1] = np.maximum(prod[b1], 2) - 2
+        prod[b2] = np.maximum(prod[b2], 5) - 5
+        prod[b3] = np.maximum(prod[b3], 8) - 8
+        status[b1] = 1
+        status[b2 | b3] = 2
+        status[inf & ~b1 & ~b2 & ~b3] = 3
+
+    def leaf_death(self):
+        L = self.leaves
+        L.status[(L.idays >= self.lp.benchmark_3) | (L.age >= self.params.age_3)] = 3
+
+    def latent_counts(self, exchange=None):
+        """
+        latent leaves per plant and per grid cell (Plant/Grid.get_inf_leaves)
+        """
+        L, B, P = self.leaves, self.branches, self.plants
+        branch_inf = np.bincount(L.branch[L.status == 1], minlength=len(B))
+        plant_inf = np.bincount(B.plant, weights=branch_inf, minlength=len(P)).astype(np.int64)
+        grid_inf = np.bincount(P.grid, weights=plant_inf, minlength=len(self.cells)).astype(np.int64)
+        if exchange is not None:
+            grid_inf = exchange(grid_inf)
+        return plant_inf, grid_inf
+
+    def production(self):
+        """
+        a day's production of each branch (0.1 * prod of its living leaves)
+        """
+        L = self.leaves
+        alive = L.status < 3
+        return np.bincount(L.branch[alive], weights=0.1 * L.prod[alive] * self.lp.productivity[alive],
+                           minlength=len(self.branches))
+
+    def production_l(self):
+        """
+        leaf production - like Branch.production_l, a batch of k new leaves costs k*k*leaf_cost
+        """
+        B = self.branches
+        B.leaf_prod[:] += self.production()
+        new = np.floor(B.leaf_prod / self.params.leaf_cost).astype(np.int64)
+        grow = np.flatnonzero(new > 0)
+        if len(grow) == 0:
+            return
+        k = new[grow]
+        B.leaf_prod[grow] -= k * k * self.params.leaf_cost
+        self.add_leaves(np.repeat(grow, k), leaf=np.repeat(B.n_leaves[grow] + k, k), age=0, prod=8)
+        B.n_leaves[grow] += k
+
+    def production_b(self, days=1):
+        """
+        berry production
+        """
+        B = self.branches
+        B.berry_prod[:] += days * self.production()
+        berries = np.floor(B.berry_prod / self.params.berry_cost)
+        B.berries[:] += berries.astype(np.int64)
+        B.berry_prod[:] -= berries * self.params.berry_cost
+
+    def germ_rust(self, streams):
+        """
+        spores on healthy leaves germinate, returns the newly infected leaves
+        """
+        L = self.leaves
+        germ = np.flatnonzero((L.status == 0) & (L.clr_germs > 0))
+        if len(germ) == 0:
+            return germ
+        chance = self.lp.germ_chance[germ]
+        if self.protection is not None:
+            efficacy, until = self.protection
+            cell = L.grid[germ]
+            chance = chance * np.where(self.time < until[cell], 1 - efficacy[cell], 1.0)
+        took = germ[self.binomial(streams, L.grid[germ], L.clr_germs[germ], chance) > 0]
+        L.status[took] = 1
+        L.idays[took] = 1
+        return took
+
+    def infection(self, streams, plant_inf, grid_inf):
+        """
+        spores reach healthy leaves from latent leaves on the same branch, plant or grid cell.
+        The widest level with infected leaves sets the spore count, as in Branch.infection
+        where grid overwrites plant overwrites branch.
+        """
+        p = self.params
+        L = self.leaves
+        status = L.status
+        branch_now = np.bincount(L.branch[status == 1], minlength=len(self.branches))
+        healthy = np.flatnonzero(status == 0)
+        hb = L.branch[healthy]
+        hp = L.plant[healthy]
+        n_branch = branch_now[hb]
+        n_plant = plant_inf[hp] - branch_now[hb]
+        n_grid = grid_inf[L.grid[healthy]] - plant_inf[hp]
+        by_grid = n_grid > 0
+        by_plant = ~by_grid & (n_plant > 0)
+        by_branch = ~by_grid & ~by_plant & (n_branch > 0)
+        spores = by_grid | by_plant | by_branch
+        n = np.where(by_grid, n_grid, np.where(by_plant, n_plant, n_branch))[spores]
+        chance = np.where(by_grid, p.clr_g, np.where(by_plant, p.clr_p, p.clr_b))[spores]
+        L.clr_germs[healthy[spores]] = self.binomial(streams, L.grid[healthy[spores]], n, chance)
+        if self.log is not None:
+            self.log.spores(healthy[spores], np.where(by_grid, 2, np.where(by_plant, 1, 0))[spores])
+
+    def binomial(self, streams, cell, n, chance):
+        """
+        Binomial draws, one per entry of cell (local grid cell numbers), each cell
+        drawing from its own stream of the day in the order of the entries
+        """
+        chance = np.broadcast_to(chance, len(cell))
+        return self.per_cell(streams, cell, lambda rng, part: rng.binomial(n[part], chance[part]), np.int64)
+
+    def per_cell(self, streams, cell, draw, dtype, stream=None):
+        """
+        Run draw(rng, part) for the entries of each grid cell with that cell's stream of the day.
+        stream names another Streams method of (cell, day) to draw from, e.g. 'event'.
+        """
+        out = np.zeros(len(cell), dtype=dtype)
+        if len(cell) == 0:
+            return out
+        order = np.argsort(cell, kind='stable')
+        bounds = np.searchsorted(cell[order], np.arange(len(self.cells) + 1))
+        for c in np.flatnonzero(np.diff(bounds)):
+            part = order[bounds[c]:bounds[c + 1]]
+            if stream is None:
+                rng = self.day_stream(streams, c)
+            else:
+                rng = getattr(streams, stream)(self.cell_ids[c], self.time)
+            out[part] = draw(rng, part)
+        return out
+
+    def day_stream(self, streams, cell):
+        """
+        generator of a (local) grid cell for the current day, created on first use
+        """
+        rng = self._day_streams.get(cell)
+        if rng is None:
+            rng = self._day_streams[cell] = streams.day(self.cell_ids[cell], self.time)
+        return rng
+
+    def summary(self):
+        """
+        healthy, infected and dead leaves and berries per branch, as in make_frame_branches()
+        """
+        L, nb = self.leaves, len(self.branches)
+        status = L.status
+        return {'dead': np.bincount(L.branch[status == 3], minlength=nb),
+                'healthy': np.bincount(L.branch[status == 0], minlength=nb),
+                'infected': np.bincount(L.branch[(status == 1) | (status == 2)], minlength=nb),
+                'berries': self.branches.berries.copy()}
+
+    def free(self):
+        for t in (self.leaves, self.lp, self.branches, self.plants):
+            t.free()
+
+
+class Recorder:
+    """
+    Collects the daily branch summaries of a run and turns them into the branch level data frame
+    """
+
+    def __init__(self, plantation):
+        self.plantation = plantation
+        self.days = []
+        self.times = []
+
+    def record(self, time):
+        self.days.append(self.plantation.summary())
+        self.times.append(time)
+
+    def frame(self):
+        return branch_frame(self.plantation, self.days, self.times)
+
+
+def branch_frame(plantation, days, times):
+    """
+    Branch level data frame with the columns of model_2.2.py
+    (dead, healthy, infected, plant, branch, grid, berries, time)
+    """
+    B, P = plantation.branches, plantation.plants
+    nb, nd = len(B), len(days)
+    labels = np.array([plantation.params.cell_label(c) for c in plantation.cells])
+    cols = {k: np.concatenate([d[k] for d in days]) if nd else np.zeros(0, dtype=np.int64)
+            for k in ['dead', 'healthy', 'infected', 'berries']}
+    return pd.DataFrame({'dead': cols['dead'], 'healthy': cols['healthy'], 'infected': cols['infected'],
+                         'plant': np.tile(P.plant[B.plant].astype(str), nd),
+                         'branch': np.tile(B.branch, nd),
+                         'grid': np.tile(labels[B.grid], nd),
+                         'berries': cols['berries'],
+                         'time': np.repeat(np.asarray(times, dtype=np.int64), nb)})
+
+
+def peak_infected(df, by=None):
+    """
+    largest share of infected living leaves over the days of a run, per value of the column by if given
+    """
+    daily = df.groupby(['time'] if by is None else ['time', by])[['healthy', 'infected']].sum()
+    living = daily['healthy'] + daily['infected']
+    share = (daily['infected'] / living.where(living > 0)).fillna(0.0)
+    return float(share.max()) if by is None else share.groupby(level=by).max()
+
+
+def group_frame(df):
+    """
+    mean branch values per day and grid cell, as grouped_tg in model_2.2.py
+    """
+    grouped = df.groupby(['time', 'grid']).agg({'healthy': 'mean', 'dead': 'mean', 'infected': 'mean',
+                                                 'berries': 'mean'})
+    return grouped.reset_index(drop=False)
+
+
+def run(params=None, seed=None, days=None, monitor=None, replicate=0, log=None, compact=False):
+    """
+    Build a plantation and run it day by day, returns the branch level data frame.
+    seed is the root seed (or a Streams), replicate picks the replicate's streams.
+    monitor, if given, is called as monitor(plantation, time) at the end of every day.
+    log, a TransitionLog, records the status changes of the leaves.
+    compact stores the leaves in narrow types, the results are the same.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    streams = as_streams(seed, replicate)
+    plantation = Plantation.build(params, streams, compact=compact)
+    if log is not None:
+        log.start(plantation)
+    recorder = Recorder(plantation)
+    for time in range(days):
+        plantation.step(streams)
+        recorder.record(time)
+        if monitor is not None:
+            monitor(plantation, time)
+    return recorder.frame()
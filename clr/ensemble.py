@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.engine import peak_infected
+from clr.streams import as_streams
+
+
+# engines that call a monitor each day, so a running replicate can be cancelled
+_monitored = {'leaf', 'tau'}
+
+# set in worker processes, tells running replicates to stop
+_stop = None
+
+
+class Cancelled(Exception):
+    """
+    raised inside a run that was cancelled
+    """
+
+
+def _init_worker(stop):
+    global _stop
+    _stop = stop
+
+
+def _check_stop(plantation, time):
+    if _stop is not None and _stop.is_set():
+        raise Cancelled()
+
+
+def run_task(task):
+    """
+    One run of simulate() from a (params, seed, days, engine, replicate, options, cache) task.
+    Runs of monitored engines check the stop flag daily and give up once it is set.
+    """
+    from clr.runner import simulate
+    from clr.cache import run_key
+    params, seed, days, engine, replicate, options, cache = task
+    if engine not in _monitored or 'monitor' in options:
+        return simulate(params, seed, days, engine, replicate, cache=cache, **options)
+    key = run_key(params, seed, days, engine, replicate, options) if cache is not None else None
+    df = cache.get(key) if key is not None else None
+    if df is None:
+        df = simulate(params, seed, days, engine, replicate, monitor=_check_stop, **options)
+        if key is not None and isinstance(df, pd.DataFrame):
+            cache.put(key, df)
+    return df
+
+
+def _call(fn, task):
+    try:
+        return fn(task)
+    except Cancelled:
+        return None
+
+
+def map_runs(tasks, fn=run_task, workers=None, done=None):
+    """
+    Evaluate fn over tasks, at most workers at a time, yielding (number, result) as runs finish.
+    tasks can be a generator, it is only drawn from when a worker is free. If done() turns
+    true no more tasks are started, the queued ones are dropped and running ones are asked to
+    stop (results of cancelled runs are not yielded).
+    With workers=1 the tasks run one after the other in this process.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    tasks = iter(tasks)
+    if workers <= 1:
+        for number, task in enumerate(tasks):
+            if done is not None and done():
+                return
+            yield number, fn(task)
+        return
+
+    stop = mp.get_context().Event()
+    pending = {}
+    number = 0
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(stop,)) as pool:
+        try:
+            while True:
+                while len(pending) < workers and not (done is not None and done()):
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    pending[pool.submit(_call, fn, task)] = number
+                    number += 1
+                if not pending:
+                    return
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    n = pending.pop(future)
+                    result = future.result()
+                    if result is not None:
+                        yield n, result
+                if done is not None and done():
+                    return
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+
+
+def targets(df):
+    """
+    Per-cell outputs of one run: berries per branch on the last day and the largest share of
+    infected living leaves over the run (named 'berries_<grid>' and 'peak_infected_<grid>')
+    """
+    last = df[df['time'] == df['time'].max()].groupby('grid')['berries'].mean()
+    peak = peak_infected(df, 'grid')
+    out = {}
+    for grid in last.index:
+        out['berries_%s' % grid] = float(last[grid])
+        out['peak_infected_%s' % grid] = float(peak[grid])
+    return out
+
+
+class RunningStats:
+    """
+    Running mean and variance (Welford) of a set of named outputs
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.names = None
+        self.mean = None
+        self.m2 = None
+
+    def add(self, values):
+        if self.names is None:
+            self.names = list(values)
+            self.mean = np.zeros(len(self.names))
+            self.m2 = np.zeros(len(self.names))
+        x = np.array([values[k] for k in self.names], dtype=float)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def std(self):
+        if self.n < 2:
+            return np.full(len(self.mean), np.inf)
+        return np.sqrt(self.m2 / (self.n - 1))
+
+    def ci_width(self, confidence=0.95):
+        """
+        full width of the confidence interval of each mean (t distribution)
+        """
+        from scipy import stats
+        if self.n < 2:
+            return np.full(len(self.mean), np.inf)
+        return 2 * stats.t.ppf(0.5 + confidence / 2, self.n - 1) * self.std() / np.sqrt(self.n)
+
+
+def run_ensemble(params=None, seed=None, days=None, engine='leaf', width=0.05, relative=True, confidence=0.95,
+                 min_runs=10, max_runs=500, workers=None, cache=None, target=targets, **options):
+    """
+    Run replicates until the confidence interval of every target output is at most width wide
+    (relative to the size of its mean if relative, the mean's absolute value or 1e-9), or
+    until max_runs. width can also be a dict by output name prefix, e.g. {'berries': 0.02,
+    'peak_infected': 0.2}. Replicate r uses the streams of (seed, r). Once the targets have
+    converged, no further replicates start and the running ones are cancelled. Only replicates
+    0..n-1 count, a finished one is held back until all replicates before it are in, so that
+    the result is the same for any number of workers.
+    target(df) gives the outputs of one run (default: targets()).
+    Returns the outputs of the counted replicates and a report per output with the mean,
+    standard deviation, interval width and whether it converged.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    seed = as_streams(seed).seed
+    stats_ = RunningStats()
+    rows = []
+    base = None
+
+    def widths(names):
+        if not isinstance(width, dict):
+            return np.full(len(names), float(width))
+        missing = [name for name in names if not any(name.startswith(k) for k in width)]
+        if missing:
+            raise ValueError('no width for the outputs %s, width has the prefixes %s'
+                             % (', '.join(missing), ', '.join(width)))
+        return np.array([next(v for k, v in width.items() if name.startswith(k)) for name in names], dtype=float)
+
+    def limits():
+        w = base.copy()
+        if relative:
+            w *= np.maximum(np.abs(stats_.mean), 1e-9)
+        return w
+
+    def converged():
+        if stats_.n < max(min_runs, 2):
+            return False
+        return bool(np.all(stats_.ci_width(confidence) <= limits()))
+
+    def done():
+        return stats_.n >= max_runs or converged()
+
+    tasks = ((params, seed, days, engine, r, options, cache) for r in range(max_runs))
+    # replicates count in the order of their numbers, not the order they finish in, so the
+    # result does not depend on the workers: later ones wait until all before them are in
+    waiting = {}
+    for r, df in map_runs(tasks, workers=workers, done=done):
+        waiting[r] = target(df)
+        while stats_.n in waiting:
+            values = waiting.pop(stats_.n)
+            if base is None:
+                base = widths(list(values))
+            rows.append(dict(values, replicate=stats_.n))
+            stats_.add(values)
+
+    outputs = pd.DataFrame(rows)
+    if len(outputs):
+        outputs = outputs[['replicate'] + [c for c in outputs.columns if c != 'replicate']]
+    if stats_.n == 0:
+        return outputs, pd.DataFrame(columns=['output', 'runs', 'mean', 'std', 'ci_width', 'limit', 'converged'])
+    ci = stats_.ci_width(confidence)
+    lim = limits()
+    report = pd.DataFrame({'output': stats_.names, 'runs': stats_.n, 'mean': stats_.mean, 'std': stats_.std(),
+                           'ci_width': ci, 'limit': lim, 'converged': ci <= lim})
+    return outputs, report
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import ast
+import os
+import random
+import time as timer
+import warnings
+from dataclasses import asdict
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from clr.params import Params
+from clr.ensemble import map_runs
+
+
+# the reference model: the Leaf/Branch/Plant/Grid classes of model_2.2.py
+reference_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model_2.2.py')
+
+# a plantation small enough for the pure Python model to run many seeds in seconds, with faster
+# spread than the defaults so that new infections (not only the first ones) are in the sample.
+# Plants and branches per plant are fixed, a random layout size hides most differences in spread.
+small = Params(plants_per_cell_min=4, plants_per_cell_max=4, branches_per_plant_min=5, branches_per_plant_max=5,
+               leaves_per_branch_min=8, leaves_per_branch_max=12, clr_b=0.02, clr_p=0.002, clr_g=0.0005, days=80)
+
+# the same plantation at the spread rates of the model, where tau-leaping takes leaps of several days
+model_rates = small.update(clr_b=Params.clr_b, clr_p=Params.clr_p, clr_g=Params.clr_g)
+
+# plantations and the engines checked on them by `python -m clr check`
+suites = {'fast': (small, ('leaf', 'tau')), 'model': (model_rates, ('tau',))}
+
+outputs = ['healthy', 'infected', 'dead', 'berries']
+
+
+@lru_cache(maxsize=4)
+def _reference_code(path):
+    """
+    imports, classes and functions of the model script, without its scenario
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    keep = (ast.Import, ast.ImportFrom, ast.ClassDef, ast.FunctionDef)
+    tree.body = [node for node in tree.body if isinstance(node, keep)]
+    return compile(tree, path, 'exec')
+
+
+def run_reference(params=None, seed=None, days=None, path=reference_path):
+    """
+    One run of the reference model: the classes of model_2.2.py with the constants of params,
+    the plantation built and stepped as the script does, random and np.random seeded with seed
+    (their state is restored afterwards). Returns the branch level data frame in the layout of
+    the array engines.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    if set(params.mixture) != {'susc'}:
+        raise ValueError('the reference model only has the susceptible variety')
+    ns = {name: value for name, value in asdict(params).items() if not isinstance(value, (dict, tuple))}
+    exec(_reference_code(path), ns)
+    Leaf, Branch, Plant, Grid = ns['Leaf'], ns['Branch'], ns['Plant'], ns['Grid']
+    p = params
+    saved = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        al, ab, ap, ag = [], [], [], []
+        for cell in params.cells():
+            cell_branches = []
+            for j in range(random.randint(p.plants_per_cell_min, p.plants_per_cell_max)):
+                plant_branches = []
+                for k in range(random.randint(p.branches_per_plant_min, p.branches_per_plant_max)):
+                    leaves = [Leaf(grid=cell, plant=j, branch=k, leaf=n, age=random.randint(p.age_min, p.age_max),
+                                   status=0, prod=10, idays=0, clr_germs=0, variety='susc')
+                              for n in range(random.randint(p.leaves_per_branch_min, p.leaves_per_branch_max))]
+                    al.extend(leaves)
+                    plant_branches.append(Branch(leaves=leaves, grid=cell, plant=j, branch=k, berries=0, leaf_prod=0,
+                                                 berry_prod=0, prod_factor=1, branch_status=0, inf_leaves=0))
+                ap.append(Plant(branches=plant_branches, grid=cell, plant=j, infected=0, variety='susc'))
+                cell_branches.extend(plant_branches)
+            ab.extend(cell_branches)
+            ag.append(Grid(plants=[x for x in ap if x.grid == cell], grid=cell, infected=0))
+        ns.update(al=al, ab=ab, ap=ap, ag=ag)
+
+        for leaf in al:
+            if (leaf.plant == p.infect_plant and leaf.branch == p.infect_branch and leaf.leaf in p.infect_leaves
+                    and leaf.grid in p.infect_cells):
+                leaf.status = 1
+                leaf.idays = 1
+
+        rows = []
+        for time in range(days):
+            [x.aging() for x in al]
+            [x.clr_progression() for x in al]
+            [x.leaf_death() for x in al]
+            [x.get_inf_leaves() for x in ab]
+            [x.get_inf_leaves() for x in ap]
+            [x.get_inf_leaves() for x in ag]
+            [x.production_l() for x in ab]
+            [x.production_b() for x in ab]
+            [x.germ_rust() for x in al]
+            [x.infection() for x in ab]
+            rows.extend(ns['make_frame_branches'](ab, time))
+    finally:
+        random.setstate(saved[0])
+        np.random.set_state(saved[1])
+    df = pd.DataFrame(rows, columns=['dead', 'healthy', 'infected', 'plant', 'branch', 'grid', 'berries', 'time'])
+    df['plant'] = df['plant'].astype(str)
+    df['grid'] = [params.cell_label(c) for c in df['grid']]
+    return df
+
+
+def _equivalence_task(task):
+    """
+    one timed run, reduced to the mean branch values per grid cell on the compared days. Engines that
+    leap over days (tau) give, for a compared day, their last recorded day at or before it (recorded).
+    """
+    from clr.runner import simulate
+    from clr.engine import group_frame
+    label, engine, params, seed, days, replicate, times, options = task
+    start = timer.perf_counter()
+    if engine == 'reference':
+        df = run_reference(params, seed + replicate, days)
+    elif callable(engine):
+        df = engine(params, seed, days, replicate, **options)
+    else:
+        df = simulate(params, seed, days, engine, replicate, **options)
+    took = timer.perf_counter() - start
+    g = group_frame(df).rename(columns={'time': 'recorded'})
+    recorded = np.sort(g['recorded'].unique())
+    last = np.searchsorted(recorded, times, side='right') - 1
+    compared = pd.DataFrame({'time': np.asarray(times)[last >= 0], 'recorded': recorded[last[last >= 0]]})
+    g = compared.merge(g, on='recorded')
+    g['engine'], g['replicate'], g['seconds'] = label, replicate, took
+    return g
+
+
+def holm(p):
+    """
+    Holm adjusted p values (family-wise error rate)
+    """
+    p = np.asarray(p, dtype=float)
+    order = np.argsort(p)
+    m = len(p)
+    adjusted = np.empty(m)
+    adjusted[order] = np.minimum(np.maximum.accumulate(p[order] * (m - np.arange(m))), 1.0)
+    return adjusted
+
+
+def _tests(label, grid, time, ref, cand):
+    """
+    two-sample tests of each output for one grid cell and compared day
+    """
+    tests = []
+    for c in outputs:
+        a, b = ref[c].to_numpy(), cand[c].to_numpy()
+        with warnings.catch_warnings():
+            # ties in the counts make the exact KS distribution fall back to the asymptotic one
+            warnings.simplefilter('ignore', RuntimeWarning)
+            pairs = [('ks', stats.ks_2samp(a, b)), ('mannwhitney', stats.mannwhitneyu(a, b))]
+        for test, r in pairs:
+            tests.append({'engine': label, 'grid': grid, 'time': time, 'output': c, 'test': test,
+                          'reference_mean': a.mean(), 'engine_mean': b.mean(), 'statistic': r.statistic,
+                          'p': r.pvalue})
+    return tests
+
+
+def equivalence(params=None, runs=60, seed=0, days=None, engines=('leaf', 'tau'), every=20, alpha=0.01,
+                workers=1, **options):
+    """
+    Check engines against the reference model of model_2.2.py. Both run on runs seeds, and on every
+    every-th day (and the last one) the distributions over seeds of the mean healthy, infected and
+    dead leaves and berries per branch of each grid cell are compared with two-sample
+    Kolmogorov-Smirnov and Mann-Whitney tests (the second one finds shifts of the mean with fewer
+    runs). An engine passes if no test rejects at alpha after a Holm correction over all its tests.
+    engines are names for simulate() or {label: fn} with fn(params, seed, days, replicate, **options)
+    returning the branch level data frame (module level functions, if workers > 1). The partitioned
+    engine gives the same runs as leaf for the same seed, so it is only worth adding to check the tiling.
+    An engine that leaps over a compared day (tau) is compared on its last recorded day before
+    it, each run against a reference run on the same day. A compared day and grid cell that an
+    engine has no values for fails as a 'missing' test.
+    Returns the report (one row per engine: runs, seconds per run, speedup over the reference,
+    tests, failed tests, missing days, smallest adjusted p, passed) and the tests.
+    """
+    params = small if params is None else params
+    days = params.days if days is None else days
+    times = sorted(set(range(every - 1, days, every)) | {days - 1})
+    engines = dict(engines) if isinstance(engines, dict) else {name: name for name in engines}
+    labels = ['reference'] + list(engines)
+    # the reference keeps every day, to be compared on the days a leaping engine recorded
+    tasks = [(label, 'reference', params, seed, days, r, list(range(days)), {}) if label == 'reference' else
+             (label, engines[label], params, seed, days, r, times, options) for label in labels for r in range(runs)]
+    results = pd.concat([g for _, g in map_runs(tasks, fn=_equivalence_task, workers=workers)], ignore_index=True)
+
+    per_run = results.groupby(['engine', 'replicate'])['seconds'].first().groupby(level='engine').mean()
+    reference = results[results['engine'] == 'reference'].set_index(['replicate', 'grid', 'recorded'])
+    cells = reference.index.get_level_values('grid').unique()
+    rows, report = [], []
+    for label in engines:
+        candidate = results[results['engine'] == label].groupby(['grid', 'time'])
+        tests = []
+        for grid in cells:
+            for time in times:
+                if (grid, time) not in candidate.groups:
+                    tests.append({'engine': label, 'grid': grid, 'time': time, 'output': None, 'test': 'missing'})
+                    continue
+                cand = candidate.get_group((grid, time))
+                # each candidate run against a reference run on the day the candidate recorded
+                ref = reference.loc[list(zip(cand['replicate'], cand['grid'], cand['recorded']))]
+                tests.extend(_tests(label, grid, time, ref, cand))
+        tests = pd.DataFrame(tests, columns=['engine', 'grid', 'time', 'output', 'test', 'reference_mean',
+                                             'engine_mean', 'statistic', 'p'])
+        missing = (tests['test'] == 'missing').to_numpy()
+        # samples that are all the same value
+        tests.loc[~missing, 'p'] = tests.loc[~missing, 'p'].fillna(1.0)
+        tests['p_adjusted'] = np.nan
+        tests.loc[~missing, 'p_adjusted'] = holm(tests.loc[~missing, 'p'])
+        tests['passed'] = ~missing & (tests['p_adjusted'] >= alpha)
+        rows.append(tests)
+        report.append({'engine': label, 'runs': runs, 'seconds': per_run[label],
+                       'speedup': per_run['reference'] / per_run[label], 'tests': int((~missing).sum()),
+                       'failed': int((~tests['passed']).sum()), 'missing': int(missing.sum()),
+                       'min_p': tests['p_adjusted'].min(),
+                       'passed': bool(tests['passed'].all())})
+    report.insert(0, {'engine': 'reference', 'runs': runs, 'seconds': per_run['reference'], 'speedup': 1.0})
+    return pd.DataFrame(report), pd.concat(rows, ignore_index=True)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# one transition: leaf row, day, old and new status, level the spores came from
+record_dtype = np.dtype([('leaf', '<i4'), ('day', '<i2'), ('old', 'i1'), ('new', 'i1'), ('source', 'i1')])
+
+# source levels of an infection, -1 for transitions that are not infections
+levels = ['branch', 'plant', 'grid']
+
+# old status of a leaf's first record (the leaf appears)
+BORN = -1
+
+
+class TransitionLog:
+    """
+    Append-only log of leaf status changes. At the end of every step the leaf statuses are
+    compared with the previous day's and each change is appended as a 9 byte record (leaf row,
+    day, old status, new status, source level), new leaves with old status BORN. Infections
+    carry the level (branch, plant or grid) that delivered the spores they germinated from.
+    With a path the records go to a file, otherwise to memory. Per-leaf trajectories are
+    rebuilt from the records on demand; the index by leaf is built once, on first use.
+    """
+
+    def __init__(self, path=None, flush=1 << 16):
+        self.path = path
+        self.flush_size = flush
+        self.chunks = []
+        self.pending = []
+        self.n_pending = 0
+        self.last = None
+        self.level = np.zeros(0, dtype=np.int8)
+        self._index = None
+        if path is not None:
+            open(path, 'wb').close()
+
+    def start(self, plantation):
+        """
+        Attach to a plantation and log its leaves as they are at the start (day -1)
+        """
+        plantation.log = self
+        status = plantation.leaves.status
+        self._append(np.arange(len(status)), -1, np.full(len(status), BORN), status, np.full(len(status), -1))
+        self.last = status.astype(np.int8)
+
+    def spores(self, leaves, level):
+        """
+        called by Plantation.infection with the leaves that got spores and the level they came from
+        """
+        if len(leaves) == 0:
+            return
+        size = int(leaves.max()) + 1
+        if size > len(self.level):
+            self.level = np.concatenate([self.level, np.zeros(max(size, 2 * len(self.level)) - len(self.level),
+                                                              dtype=np.int8)])
+        self.level[leaves] = level
+
+    def record(self, plantation):
+        """
+        append the changes since the last call, as of the day just finished
+        """
+        status = plantation.leaves.status
+        day = plantation.time - 1
+        n_old = len(self.last)
+        changed = np.flatnonzero(status[:n_old] != self.last)
+        old, new = self.last[changed], status[changed]
+        source = np.full(len(changed), -1, dtype=np.int8)
+        infected = (old == 0) & (new == 1)
+        leaves = changed[infected]
+        known = leaves < len(self.level)
+        source[np.flatnonzero(infected)[known]] = self.level[leaves[known]]
+        self._append(changed, day, old, new, source)
+        born = np.arange(n_old, len(status))
+        self._append(born, day, np.full(len(born), BORN), status[born], np.full(len(born), -1))
+        self.last = status.astype(np.int8)
+
+    def _append(self, leaf, day, old, new, source):
+        if len(leaf) == 0:
+            return
+        rec = np.empty(len(leaf), dtype=record_dtype)
+        rec['leaf'], rec['day'], rec['old'], rec['new'], rec['source'] = leaf, day, old, new, source
+        self.pending.append(rec)
+        self.n_pending += len(rec)
+        self._index = None
+        if self.n_pending >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        block = np.concatenate(self.pending)
+        self.pending, self.n_pending = [], 0
+        if self.path is None:
+            self.chunks.append(block)
+        else:
+            with open(self.path, 'ab') as f:
+                f.write(block.tobytes())
+
+    def records(self):
+        """
+        all records so far, in the order they were logged
+        """
+        self.flush()
+        if self.path is not None:
+            return np.fromfile(self.path, dtype=record_dtype)
+        if not self.chunks:
+            return np.zeros(0, dtype=record_dtype)
+        if len(self.chunks) > 1:
+            self.chunks = [np.concatenate(self.chunks)]
+        return self.chunks[0]
+
+    def nbytes(self):
+        self.flush()
+        if self.path is not None:
+            return os.path.getsize(self.path)
+        return sum(c.nbytes for c in self.chunks)
+
+    def _by_leaf(self):
+        if self._index is None:
+            rec = self.records()
+            order = np.argsort(rec['leaf'], kind='stable')
+            starts = np.searchsorted(rec['leaf'][order], np.arange(rec['leaf'].max() + 2 if len(rec) else 1))
+            self._index = rec[order], starts
+        return self._index
+
+    def events(self, leaf):
+        """
+        the records of one leaf, in day order
+        """
+        rec, starts = self._by_leaf()
+        if leaf + 1 >= len(starts):
+            return rec[:0]
+        return rec[starts[leaf]:starts[leaf + 1]]
+
+    def trajectory(self, leaf, days):
+        """
+        status of a leaf on each of days 0 .. days-1 (BORN before it exists)
+        """
+        ev = self.events(leaf)
+        status = np.full(days, BORN, dtype=np.int8)
+        for day, new in zip(ev['day'], ev['new']):
+            status[max(int(day), 0):] = new
+        return status
+
+    def status_on(self, day):
+        """
+        status of every leaf at the end of a day (BORN for leaves not yet there)
+        """
+        rec = self.records()
+        upto = rec[rec['day'] <= day]
+        n = int(rec['leaf'].max()) + 1 if len(rec) else 0
+        status = np.full(n, BORN, dtype=np.int8)
+        # records are in day order, so the last write per leaf wins
+        status[upto['leaf']] = upto['new']
+        return status
+
+    def history(self):
+        """
+        One row per leaf: day it appeared, was infected, started to sporulate and died (-1 if it
+        did not), and the level its infection came from
+        """
+        rec = self.records()
+        n = int(rec['leaf'].max()) + 1 if len(rec) else 0
+        out = {}
+        for name, hit in [('born', rec['old'] == BORN), ('infected', (rec['new'] == 1) & (rec['old'] != BORN)),
+                          ('sporulating', rec['new'] == 2), ('dead', rec['new'] == 3)]:
+            first = np.full(n, -1, dtype=np.int64)
+            r = rec[hit]
+            # first event per leaf: write in reverse day order so the earliest remains
+            first[r['leaf'][::-1]] = r['day'][::-1]
+            out[name] = first
+        source = np.full(n, -1, dtype=np.int8)
+        r = rec[(rec['new'] == 1) & (rec['old'] == 0)]
+        source[r['leaf'][::-1]] = r['source'][::-1]
+        out['source'] = pd.Categorical.from_codes(source, levels) if n else pd.Categorical([], levels)
+        return pd.DataFrame(out)
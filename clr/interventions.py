@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.engine import Plantation, Recorder, peak_infected
+from clr.streams import as_streams
+from clr.ensemble import map_runs
+
+
+def _cell_mask(plantation, cells):
+    """
+    mask over the plantation's (local) grid cells, all cells for None
+    """
+    if cells is None:
+        return np.ones(len(plantation.cells), dtype=bool)
+    wanted = {tuple(c) for c in cells}
+    return np.array([c in wanted for c in plantation.cells])
+
+
+@dataclass
+class Spray:
+    """
+    Fungicide on the grid cells in cells (None for all) on day. For duration days (the spray day
+    included) each spore on a leaf of these cells is killed with chance efficacy before it can
+    germinate, a later spray of a cell replaces its cover. A curative spray also cures latent
+    (not yet sporulating) leaves with chance efficacy on the day.
+    """
+    day: int
+    cells: tuple = None
+    efficacy: float = 0.9
+    curative: bool = False
+    duration: int = 14
+
+    def apply(self, plantation, streams, totals):
+        L = plantation.leaves
+        cover = _cell_mask(plantation, self.cells)
+        if plantation.protection is None:
+            n = len(plantation.cells)
+            plantation.protection = (np.zeros(n), np.zeros(n, dtype=np.int64))
+        efficacy, until = plantation.protection
+        efficacy[cover] = self.efficacy
+        until[cover] = plantation.time + self.duration
+        if self.curative:
+            latent = np.flatnonzero(cover[L.grid] & (L.status == 1))
+            draw = plantation.per_cell(streams, L.grid[latent], lambda rng, part: rng.random(len(part)), np.float64,
+                                       stream='event')
+            cured = latent[draw < self.efficacy]
+            L.status[cured] = 0
+            L.idays[cured] = 0
+            L.clr_germs[cured] = 0
+
+
+@dataclass
+class Prune:
+    """
+    On day, cut the branches (in cells, None for all) whose share of infected living leaves is
+    above threshold. Their leaves die and the branch stops producing; berries already on the
+    branch stay until harvest.
+    """
+    day: int
+    threshold: float = 0.2
+    cells: tuple = None
+
+    def apply(self, plantation, streams, totals):
+        L, B = plantation.leaves, plantation.branches
+        nb = len(B)
+        alive = L.status < 3
+        living = np.bincount(L.branch[alive], minlength=nb)
+        infected = np.bincount(L.branch[(L.status == 1) | (L.status == 2)], minlength=nb)
+        cut = (_cell_mask(plantation, self.cells)[B.grid] & (living > 0)
+               & (infected > self.threshold * np.maximum(living, 1)))
+        L.status[cut[L.branch] & alive] = 3
+        B.leaf_prod[cut] = 0
+        B.berry_prod[cut] = 0
+        totals['pruned'] += np.bincount(B.grid[cut], minlength=len(plantation.cells))
+
+
+@dataclass
+class Harvest:
+    """
+    Pick the berries of the branches in cells (None for all) on day
+    """
+    day: int
+    cells: tuple = None
+
+    def apply(self, plantation, streams, totals):
+        B = plantation.branches
+        picked = _cell_mask(plantation, self.cells)[B.grid]
+        totals['harvested'] += np.bincount(B.grid[picked], weights=B.berries[picked],
+                                           minlength=len(plantation.cells))
+        B.berries[picked] = 0
+
+
+def run_schedule(schedule, params=None, seed=None, days=None, replicate=0, monitor=None, log=None):
+    """
+    Run the leaf model with a schedule of interventions (Spray, Prune, Harvest). Events of a day
+    are applied in schedule order before the day's step, each as one operation over the leaves
+    or branches of its cells. Random draws come from the cells' intervention streams, so the
+    model's own draws are the same as in an untreated run with the same seed.
+    Returns the branch level data frame and a frame per grid cell with the harvested berries
+    and pruned branches. A TransitionLog logs the treatments' status changes on the day they
+    are applied.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    streams = as_streams(seed, replicate)
+    plantation = Plantation.build(params, streams)
+    if log is not None:
+        log.start(plantation)
+    recorder = Recorder(plantation)
+    n_cells = len(plantation.cells)
+    totals = {'harvested': np.zeros(n_cells), 'pruned': np.zeros(n_cells, dtype=np.int64)}
+    by_day = {}
+    for event in schedule:
+        by_day.setdefault(int(event.day), []).append(event)
+    for time in range(days):
+        for event in by_day.get(time, []):
+            event.apply(plantation, streams, totals)
+        plantation.step(streams)
+        recorder.record(time)
+        if monitor is not None:
+            monitor(plantation, time)
+    cells = pd.DataFrame({'grid': [params.cell_label(c) for c in plantation.cells],
+                          'harvested': totals['harvested'], 'pruned': totals['pruned']})
+    return recorder.frame(), cells
+
+
+def schedule_outcome(df, cells):
+    """
+    Outcome of a treated run: berries per branch (harvested plus those still on the branches on
+    the last day), infected leaves per branch on the last day and the peak infected share
+    """
+    last = df[df['time'] == df['time'].max()]
+    branches = len(last)
+    return {'berries': (last['berries'].sum() + cells['harvested'].sum()) / max(branches, 1),
+            'infected': float(last['infected'].mean()), 'peak_infected': peak_infected(df),
+            'pruned': int(cells['pruned'].sum())}
+
+
+def _schedule_task(task):
+    schedule, params, seed, days, replicate = task
+    return schedule_outcome(*run_schedule(schedule, params, seed, days, replicate))
+
+
+def evaluate_schedules(schedules, params=None, seed=None, days=None, replicates=1, workers=None):
+    """
+    Outcomes (schedule_outcome()) of many schedules, run in worker processes. Every schedule
+    runs on the same replicates of the same seed, so differences come from the treatments.
+    Returns one row per schedule and replicate.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    seed = as_streams(seed).seed
+    keys = [(s, r) for s in range(len(schedules)) for r in range(replicates)]
+    tasks = [(schedules[s], params, seed, days, r) for s, r in keys]
+    rows = [dict(outcome, schedule=keys[n][0], replicate=keys[n][1])
+            for n, outcome in map_runs(tasks, fn=_schedule_task, workers=workers)]
+    out = pd.DataFrame(rows).sort_values(['schedule', 'replicate']).reset_index(drop=True)
+    return out[['schedule', 'replicate'] + [c for c in out.columns if c not in ('schedule', 'replicate')]]
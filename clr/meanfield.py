@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.varieties import VarietyTable
+
+
+# scopes of a grid cell: the first infected branch, the other branches of its plant, the other plants
+scopes = ['branch', 'plant', 'grid']
+
+
+@lru_cache(maxsize=32)
+def _leaf_rate(leaf_cost, steps=400, days=400):
+    """
+    New leaves per day of a branch producing c per day, as Branch.production_l makes them
+    (a batch of k leaves costs k*k*leaf_cost), tabulated for c in [0, 4*leaf_cost]
+    """
+    c = np.linspace(0, 4 * leaf_cost, steps)
+    store = np.zeros(steps)
+    made = np.zeros(steps)
+    for _ in range(days):
+        store += c
+        k = np.maximum(np.floor(store / leaf_cost), 0)
+        store -= k * k * leaf_cost
+        made += k
+    return c, made / days
+
+
+class MeanField:
+    """
+    Deterministic compartment model of the expected leaf counts of each grid cell.
+    Healthy leaves are held by age (0 to age_3, so productivity follows the age_1/age_2 bands
+    and leaves die at age_3) and infected leaves by days infected (latent before benchmark_1,
+    sporulating until benchmark_3), per variety. Each cell is split into three scopes - the
+    initially infected branch, the other branches of its plant and the other plants - so the
+    branch/plant/grid spread of Branch.infection (clr_b, clr_p, clr_g, the widest level with
+    infected leaves wins) keeps its structure. Infected leaves are assumed to have the age
+    distribution of the healthy leaves of their scope.
+    """
+
+    def __init__(self, params, varieties=None):
+        p = self.params = params
+        self.cells = params.cells()
+        self.varieties = VarietyTable(params, varieties)
+        vt = self.varieties.columns
+        self.plants = (p.plants_per_cell_min + p.plants_per_cell_max) / 2
+        self.per_plant = (p.branches_per_plant_min + p.branches_per_plant_max) / 2
+        self.n_branches = np.array([1, self.per_plant - 1, (self.plants - 1) * self.per_plant])
+        n_cells, n_var = len(self.cells), len(self.varieties.names)
+        share = self.varieties.weights
+
+        ages = np.arange(p.age_3)
+        self.base = np.where(ages > p.age_2, 7, np.where(ages > p.age_1, 10, 5))
+        d_max = int(vt['benchmark_3'].max()) + 1
+        d = np.arange(d_max)
+        self.latent = d[None, :] < vt['benchmark_1'][:, None]
+        self.middle = ~self.latent & (d[None, :] < vt['benchmark_2'][:, None])
+        self.late = ~self.latent & ~self.middle & (d[None, :] < vt['benchmark_3'][:, None])
+        self.gone = d[None, :] >= vt['benchmark_3'][:, None]
+
+        leaves = (p.leaves_per_branch_min + p.leaves_per_branch_max) / 2
+        start = np.zeros(p.age_3)
+        start[p.age_min:p.age_max + 1] = 1.0 / (p.age_max - p.age_min + 1)
+        self.H = (leaves * self.n_branches[None, :, None, None] * share[None, None, :, None]
+                  * start[None, None, None, :]) * np.ones((n_cells, 1, 1, 1))
+        self.I = np.zeros((n_cells, len(scopes), n_var, d_max))
+        self.dead = np.zeros(n_cells)
+        self.berries = np.zeros(n_cells)
+        self.q = np.zeros((n_cells, len(scopes), n_var))
+        self.time = 0
+
+        n = len(p.infect_leaves)
+        for cell in p.infect_cells:
+            if tuple(cell) in self.cells:
+                c = self.cells.index(tuple(cell))
+                scale = 1 - n / self.H[c, 0].sum()
+                self.H[c, 0] *= scale
+                self.I[c, 0, :, 1] = n * share
+
+        self.germ = vt['germ_chance']
+        self.productivity = vt['productivity']
+        self.rate_c, self.rate = _leaf_rate(p.leaf_cost)
+
+    def step(self):
+        """
+        Advance the expected counts by one day, in the order of the daily loop
+        """
+        p = self.params
+        H, I = self.H, self.I
+
+        # aging and age death, infected leaves die at the rate of their scope's healthy leaves
+        total = H.sum(-1)
+        h_age = np.divide(H[..., -1], total, out=np.zeros_like(total), where=total > 0)
+        died = I * h_age[..., None]
+        self.dead += H[..., -1].sum((1, 2)) + died.sum((1, 2, 3))
+        I -= died
+        H[..., 1:] = H[..., :-1].copy()
+        H[..., 0] = 0
+
+        # clr progression and death at benchmark_3
+        I[..., 1:] = I[..., :-1].copy()
+        I[..., 0] = 0
+        self.dead += (I * self.gone).sum((1, 2, 3))
+        I *= ~self.gone
+
+        # production of healthy and infected leaves (infected lose 2, 5 or 8 by stage)
+        total = H.sum(-1)
+        safe = np.where(total > 0, total, 1)
+        healthy_prod = (H * self.base).sum(-1)
+        inf_prod = 0
+        for penalty, stage in ((2, self.latent), (5, self.middle), (8, self.late)):
+            mean = (H * np.maximum(self.base - penalty, 0)).sum(-1) / safe
+            inf_prod = inf_prod + mean * (I * stage).sum(-1)
+        c = (0.1 * (healthy_prod + inf_prod) * self.productivity).sum(-1) / self.n_branches
+        new = np.interp(c, self.rate_c, self.rate) * self.n_branches
+        H[..., 0] += new[..., None] * self.varieties.weights
+        per_branch = (c + 0.8 * new / self.n_branches) / p.berry_cost
+        self.berries += (per_branch * self.n_branches).sum(-1) / self.n_branches.sum()
+
+        # germination of yesterday's spores, new leaves carry none
+        infected = H[..., 1:] * self.q[..., None]
+        H[..., 1:] -= infected
+        I[..., 1] += infected.sum(-1)
+
+        # spores for tomorrow from the latent leaves of each scope
+        N = (I * self.latent).sum((2, 3))
+        self.q = 1 - np.exp(-self.pressure(N)[..., None] * self.germ)
+        self.time += 1
+
+    def pressure(self, N):
+        """
+        Expected spores per healthy leaf and day for each cell and scope, from the latent leaves
+        per scope. A level is used when the wider levels have no latent leaves, which for an
+        expected count n happens with chance exp(-n).
+        """
+        p = self.params
+        n0, n1, n2 = N[:, 0], N[:, 1], N[:, 2]
+        per_plant = max(self.per_plant - 1, 1e-9)
+        own_plant = n2 / max(self.plants - 1, 1e-9)
+        own_branch = own_plant / self.per_plant
+        levels = [(n2, n1, n0),
+                  (n2, n0 + n1 * (self.per_plant - 2) / per_plant, n1 / per_plant),
+                  (n0 + n1 + n2 - own_plant, own_plant - own_branch, own_branch)]
+        out = np.zeros_like(N)
+        for s, (ng, np_, nb) in enumerate(levels):
+            out[:, s] = p.clr_g * ng + np.exp(-ng) * (p.clr_p * np_ + np.exp(-np_) * p.clr_b * nb)
+        return out
+
+    def summary(self):
+        """
+        per-branch means of each cell
+        """
+        branches = self.n_branches.sum()
+        latent = (self.I * self.latent).sum((1, 2, 3))
+        return {'dead': self.dead / branches, 'healthy': self.H.sum((1, 2, 3)) / branches,
+                'infected': self.I.sum((1, 2, 3)) / branches, 'latent': latent / branches,
+                'berries': self.berries.copy()}
+
+
+def run_meanfield(params=None, seed=None, days=None, replicate=0):
+    """
+    Run the compartment model. Returns a frame with the columns of the branch level data frame,
+    one row per grid cell and day holding the mean over the cell's branches (plant 'all',
+    branch -1), so group_frame() gives the same per-cell means as for the leaf model.
+    The model is deterministic, seed and replicate are accepted for the common run API.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    model = MeanField(params)
+    labels = np.array([params.cell_label(c) for c in model.cells])
+    n = len(labels)
+    cols = {k: np.zeros((days, n)) for k in ['dead', 'healthy', 'infected', 'berries']}
+    for time in range(days):
+        model.step()
+        s = model.summary()
+        for k, v in cols.items():
+            v[time] = s[k]
+    return pd.DataFrame({'dead': cols['dead'].ravel(), 'healthy': cols['healthy'].ravel(),
+                         'infected': cols['infected'].ravel(), 'plant': 'all', 'branch': -1,
+                         'grid': np.tile(labels, days), 'berries': cols['berries'].ravel(),
+                         'time': np.repeat(np.arange(days, dtype=np.int64), n)})
+
+
+def validate_meanfield(params=None, seeds=range(20), days=None, engine=None):
+    """
+    Compare the compartment model with ensemble means of the stochastic leaf model.
+    For each grid cell and output (healthy, infected, dead, berries per branch) the report
+    gives the largest and mean absolute difference relative to the largest ensemble mean, and
+    the share of days the surrogate lies within the 10-90% range of the ensemble.
+    """
+    from clr.engine import run, group_frame
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    engine = run if engine is None else engine
+    ensemble = pd.concat([group_frame(engine(params, seed, days)) for seed in seeds])
+    surrogate = group_frame(run_meanfield(params, days=days)).set_index(['time', 'grid'])
+    grouped = ensemble.groupby(['time', 'grid'])
+    mean, low, high = grouped.mean(), grouped.quantile(0.1), grouped.quantile(0.9)
+    rows = []
+    for grid in sorted(surrogate.index.get_level_values('grid').unique()):
+        for c in ['healthy', 'infected', 'dead', 'berries']:
+            m = mean[c].xs(grid, level='grid')
+            s = surrogate[c].xs(grid, level='grid').reindex(m.index)
+            lo, hi = low[c].xs(grid, level='grid'), high[c].xs(grid, level='grid')
+            scale = max(m.abs().max(), 1e-9)
+            diff = (s - m).abs()
+            rows.append({'grid': grid, 'output': c, 'ensemble_max': m.max(), 'max_error': diff.max() / scale,
+                         'mean_error': diff.mean() / scale, 'in_band': ((s >= lo) & (s <= hi)).mean()})
+    return pd.DataFrame(rows)
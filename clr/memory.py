@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.engine import leaf_columns, compact_leaf_columns, branch_columns, plant_columns
+from clr.varieties import param_columns, compact_param_columns
+
+
+# bytes per row of the branch level data frame (8 columns, plant and grid as short strings),
+# and peak memory while it is built from the daily summaries, relative to the finished frame
+frame_row_bytes = 150
+frame_peak = 2.5
+
+# engines that keep every leaf in memory
+_leaf_engines = {'leaf', 'tau', 'partitioned'}
+
+
+def row_bytes(columns):
+    return sum(np.dtype(d).itemsize for d in columns.values())
+
+
+def _capacity(start, rows):
+    """
+    capacity a Table started at start rows ends with after growing to rows (it doubles)
+    """
+    capacity = max(start, 32)
+    while capacity < rows:
+        capacity *= 2
+    return capacity
+
+
+def projected_memory(params=None, days=None, compact=True, workers=1):
+    """
+    Memory a run of the leaf engines would need, before anything is allocated.
+    Leaves are never removed, so the leaf table ends with the starting leaves plus all leaves
+    grown during the run - taken from the compartment model (clr/meanfield.py). The table doubles
+    its capacity when it grows, and while a column is copied the old one is still held.
+    Returns a frame with rows per part (leaves, branches, plants, output) and the bytes of each
+    in the leaf engines and, with workers > 1, per partitioned worker.
+    """
+    from clr.meanfield import MeanField
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    p = params
+    n_cells = len(params.cells())
+    plants = n_cells * (p.plants_per_cell_min + p.plants_per_cell_max) / 2
+    branches = plants * (p.branches_per_plant_min + p.branches_per_plant_max) / 2
+    start = branches * (p.leaves_per_branch_min + p.leaves_per_branch_max) / 2
+
+    # leaves per branch at the end, dead ones included, from one cell of the compartment model
+    model = MeanField(params.update(grid_size=1, infect_cells=((0, 0),)))
+    for _ in range(days):
+        model.step()
+    s = model.summary()
+    per_branch = float(s['healthy'][0] + s['infected'][0] + s['dead'][0])
+    rows = max(branches * per_branch, start)
+
+    leaf = compact_leaf_columns if compact else leaf_columns
+    lp = compact_param_columns if compact else param_columns
+    leaf_row = row_bytes(leaf) + row_bytes(lp)
+    widest = max(np.dtype(d).itemsize for d in list(leaf.values()) + list(lp.values()))
+    capacity = _capacity(int(start), int(np.ceil(rows)))
+    # the last growth copied one column while the previous capacity was still held
+    growth = widest * (capacity // 2 if capacity > start else 0)
+    branch_row, plant_row = row_bytes(branch_columns), row_bytes(plant_columns)
+    parts = [('leaves', rows, leaf_row, capacity * leaf_row + growth),
+             ('branches', branches, branch_row, _capacity(int(branches), int(branches)) * branch_row),
+             ('plants', plants, plant_row, _capacity(int(plants), int(plants)) * plant_row),
+             ('output', branches * days, frame_row_bytes, frame_peak * branches * days * frame_row_bytes)]
+    out = pd.DataFrame(parts, columns=['part', 'rows', 'row_bytes', 'bytes'])
+    # a partitioned worker holds its share of the state and of the output
+    out['worker_bytes'] = out['bytes'] / max(workers, 1)
+    return out
+
+
+def plan(params=None, budget=None, days=None, engine='leaf', workers=None, fallback=True):
+    """
+    Pick an engine that fits in budget bytes (per process). A leaf engine run uses the compact
+    layout; if it does not fit, the grid is partitioned over workers processes, and if a
+    worker's share still does not fit the compartment model is used. Without fallback a run
+    that does not fit in the requested engine raises MemoryError.
+    Returns the engine, its options and the projection.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    workers = os.cpu_count() if workers is None else workers
+    if engine not in _leaf_engines:
+        return engine, {}, None
+    projection = projected_memory(params, days, compact=True, workers=workers)
+    total = int(projection['bytes'].sum())
+    # the parent of a partitioned run gathers the output of all workers
+    per_worker = int(projection.loc[projection['part'] != 'output', 'worker_bytes'].sum())
+    output = int(projection.loc[projection['part'] == 'output', 'bytes'].sum())
+    if budget is None or total <= budget:
+        return engine, {'compact': True}, projection
+    if not fallback:
+        raise MemoryError('a %s run needs about %.1f MB, the budget is %.1f MB'
+                          % (engine, total / 2 ** 20, budget / 2 ** 20))
+    if workers > 1 and max(per_worker + output / workers, output) <= budget:
+        warnings.warn('%s run needs about %.1f MB, running partitioned over %d workers'
+                      % (engine, total / 2 ** 20, workers))
+        return 'partitioned', {'compact': True, 'workers': workers}, projection
+    warnings.warn('%s run needs about %.1f MB, running the compartment model instead'
+                  % (engine, total / 2 ** 20))
+    return 'meanfield', {}, projection
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+from dataclasses import dataclass, field, fields, replace
+
+
+@dataclass
+class Params:
+    """
+    All model constants of model_2.2.py in one place, with the same names and defaults.
+    """
+    # number of plants, branches, leaves
+    plants_per_cell_min: int = 8
+    plants_per_cell_max: int = 12
+    branches_per_plant_min: int = 15
+    branches_per_plant_max: int = 20
+    leaves_per_branch_min: int = 20
+    leaves_per_branch_max: int = 30
+
+    # leaf ages
+    age_min: int = 0
+    age_max: int = 300
+
+    # production values
+    prod_factor: int = 1
+    berry_cost: int = 70
+    leaf_cost: int = 80
+
+    # virus growth benchmarks (days)
+    benchmark_1: int = 35
+    benchmark_2: int = 120
+    benchmark_3: int = 150
+
+    # virus spread to branches, plants, other plants
+    clr_b: float = 0.001
+    clr_p: float = 0.0001
+    clr_g: float = 0.00001
+
+    # chance of germination of spores
+    germ_chance: float = 0.5
+
+    # leaf age bands
+    age_1: int = 50
+    age_2: int = 250
+    age_3: int = 350
+
+    # grid layout
+    grid_size: int = 2
+
+    # share of plants of each variety (see clr/varieties.py)
+    mixture: dict = field(default_factory=lambda: {'susc': 1.0})
+
+    # start off with infected leaves on one branch in some of the grid cells
+    infect_cells: tuple = ((0, 0), (0, 1), (1, 1))
+    infect_plant: int = 2
+    infect_branch: int = 3
+    infect_leaves: tuple = (2, 3)
+
+    # length of a run (days)
+    days: int = 250
+
+    def cells(self):
+        """
+        grid cells as (x, y) tuples, in the order of model_2.2.py
+        """
+        return [(i, j) for i in range(self.grid_size) for j in range(self.grid_size)]
+
+    def cell_label(self, cell):
+        """
+        grid label used in the output frames ('01' for cell (0,1))
+        """
+        if self.grid_size > 10:
+            return '%d_%d' % cell
+        return '%d%d' % cell
+
+    def update(self, **kwargs):
+        """
+        copy with some values changed
+        """
+        return replace(self, **kwargs)
+
+
+def param_names():
+    return [f.name for f in fields(Params)]
+
+
+def _coerce(name, value):
+    """
+    value from a parameter file or the command line in the type of the field (lists become tuples)
+    """
+    default = Params.__dataclass_fields__[name].default
+
+    def as_tuple(v):
+        return tuple(as_tuple(x) for x in v) if isinstance(v, list) else v
+    if isinstance(default, tuple) and isinstance(value, list):
+        return as_tuple(value)
+    if isinstance(default, float) and isinstance(value, int):
+        return float(value)
+    return value
+
+
+def load_params(path, base=None):
+    """
+    Params from a JSON or TOML file of field names and values, missing fields keep the defaults
+    (or the values of base)
+    """
+    if path.endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            values = tomllib.load(f)
+    else:
+        import json
+        with open(path) as f:
+            values = json.load(f)
+    unknown = [k for k in values if k not in param_names()]
+    if unknown:
+        raise ValueError('unknown parameter in %s: %s' % (path, ', '.join(unknown)))
+    base = Params() if base is None else base
+    return base.update(**{k: _coerce(k, v) for k, v in values.items()})
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.engine import Plantation, Recorder, compact_leaf_columns
+from clr.shared import SharedAlloc, SharedArray
+from clr.snapshot import SnapshotWriter
+from clr.streams import as_streams
+
+
+def tiles(params, n_tiles):
+    """
+    Split the grid cells (row by row) into n_tiles contiguous tiles of cell numbers
+    """
+    n_cells = len(params.cells())
+    n_tiles = max(1, min(n_tiles, n_cells))
+    return [t.tolist() for t in np.array_split(np.arange(n_cells), n_tiles)]
+
+
+class CellExchange:
+    """
+    Per-cell latent leaf counts shared by all tiles. Every day each tile writes the counts
+    of its own cells, waits at the barrier for the others, and reads back the counts of
+    the whole grid. Days alternate between two rows, so a tile that is a day ahead never
+    overwrites counts a slower tile is still reading.
+    """
+
+    def __init__(self, counts, barrier, cells):
+        self.counts = counts
+        self.barrier = barrier
+        self.cells = np.asarray(cells)
+        self.day = 0
+
+    def __call__(self, grid_inf):
+        row = self.counts.array[self.day % 2]
+        row[self.cells] = grid_inf
+        self.barrier.wait()
+        self.day += 1
+        return row[self.cells].copy()
+
+
+def _tile_worker(tile, cells, params, streams, days, counts_name, barrier, results, release, snapshot, compact):
+    counts = SharedArray((2, len(params.cells())), np.int64, name=counts_name)
+    alloc = SharedAlloc()
+    plantation = writer = None
+    try:
+        if snapshot is not None:
+            writer = SnapshotWriter(compact_leaf_columns if compact else None, name='%s_t%d' % (snapshot, tile))
+        all_cells = params.cells()
+        plantation = Plantation.build(params, streams, cells=[all_cells[c] for c in cells], alloc=alloc,
+                                      compact=compact)
+        exchange = CellExchange(counts, barrier, cells)
+        recorder = Recorder(plantation)
+        for time in range(days):
+            plantation.step(streams, exchange=exchange)
+            recorder.record(time)
+            if writer is not None:
+                writer(plantation, time)
+        L = plantation.leaves
+        manifest = {c: (alloc.name(L.data[c]), L.data[c].dtype.str, L.n) for c in L.data}
+        results.put((tile, recorder.frame(), manifest))
+        # the parent may attach to the leaf columns until it releases the tile
+        release.wait()
+    except BaseException as e:
+        barrier.abort()
+        results.put((tile, e, None))
+    finally:
+        counts.close()
+        if writer is not None:
+            writer.close()
+        if plantation is not None:
+            plantation.free()
+        alloc.close()
+
+
+def run_partitioned(params=None, seed=None, days=None, workers=None, state=False, snapshot=None, replicate=0,
+                    compact=False):
+    """
+    Run one realization with the grid split into tiles, one worker process per tile.
+    Each worker builds and steps the leaves, branches and plants of its cells in its own
+    shared memory, and the workers only meet once a day to exchange per-cell latent counts.
+    Cells draw from their own random streams, so the result is the same as run() with the
+    same seed and replicate, whatever the number of workers.
+    Returns the branch level data frame, and with state=True also the final leaf columns
+    (read from the workers' shared memory) as a dict of arrays - grid is the cell number
+    in params.cells(), plant and branch are row numbers within the leaf's tile.
+    With a snapshot name, tile t publishes its leaves daily as snapshot '<name>_t<t>'
+    (see clr/snapshot.py). compact stores the leaves in narrow types.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    workers = os.cpu_count() if workers is None else workers
+    parts = tiles(params, workers)
+    streams = as_streams(seed, replicate)
+
+    ctx = mp.get_context()
+    counts = SharedArray((2, len(params.cells())), np.int64)
+    barrier = ctx.Barrier(len(parts))
+    results = ctx.Queue()
+    release = ctx.Event()
+    procs = [ctx.Process(target=_tile_worker, args=(t, cells, params, streams, days, counts.name, barrier,
+                                                     results, release, snapshot, compact), daemon=True)
+             for t, cells in enumerate(parts)]
+    for p in procs:
+        p.start()
+
+    frames, leaves = {}, {}
+    try:
+        for _ in parts:
+            tile, frame, manifest = results.get()
+            if isinstance(frame, BaseException):
+                raise RuntimeError('tile %d failed' % tile) from frame
+            frames[tile] = frame
+            if state:
+                leaves[tile] = _copy_columns(manifest)
+                leaves[tile]['grid'] = np.asarray(parts[tile])[leaves[tile]['grid']]
+                leaves[tile]['tile'] = np.full(len(leaves[tile]['grid']), tile)
+    finally:
+        release.set()
+        for p in procs:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+        counts.close()
+
+    df = pd.concat([frames[t] for t in range(len(parts))], ignore_index=True)
+    df = df.sort_values('time', kind='stable').reset_index(drop=True)
+    if not state:
+        return df
+    columns = {c: np.concatenate([leaves[t][c] for t in range(len(parts))]) for c in leaves[0]}
+    return df, columns
+
+
+def _copy_columns(manifest):
+    columns = {}
+    for c, (name, dtype, n) in manifest.items():
+        block = SharedArray((n,), dtype, name=name)
+        columns[c] = block.array[:n].copy()
+        block.close()
+    return columns
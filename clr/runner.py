@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+
+from clr.params import Params
+
+
+def _leaf(params, seed, days, replicate, **options):
+    from clr.engine import run
+    return run(params, seed, days, replicate=replicate, **options)
+
+
+def _tau(params, seed, days, replicate, **options):
+    from clr.tauleap import run_tau
+    return run_tau(params, seed, days, replicate=replicate, **options)
+
+
+def _partitioned(params, seed, days, replicate, tiles=None, **options):
+    from clr.partition import run_partitioned
+    # tiles, the worker processes of the run, so that it does not clash with a pool's workers
+    if tiles is not None:
+        options['workers'] = tiles
+    return run_partitioned(params, seed, days, replicate=replicate, **options)
+
+
+def _meanfield(params, seed, days, replicate, **options):
+    from clr.meanfield import run_meanfield
+    return run_meanfield(params, seed, days, replicate=replicate, **options)
+
+
+# engines by name, each returns the branch level data frame of one run
+engines = {'leaf': _leaf, 'tau': _tau, 'partitioned': _partitioned, 'meanfield': _meanfield}
+
+# bumped whenever an engine's results change, so cached runs of older versions are not reused
+engine_versions = {'leaf': 1, 'tau': 2, 'partitioned': 1, 'meanfield': 1}
+
+
+def simulate(params=None, seed=None, days=None, engine='leaf', replicate=0, cache=None, budget=None, **options):
+    """
+    Run one simulation with the named engine, options are passed on to it.
+    With a RunCache, a run with the same parameters, seed and engine version is read from disk.
+    With a memory budget (bytes), leaf engine runs use the compact leaf layout and switch to a
+    partitioned or compartment run if the projected memory does not fit (see clr/memory.py).
+    The engine that ran is in the frame's attrs['engine'].
+    """
+    if engine not in engines:
+        raise ValueError('unknown engine %r, expected one of %s' % (engine, ', '.join(engines)))
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    if budget is not None:
+        from clr.memory import plan
+        planned, extra, _ = plan(params, budget, days, engine, options.get('tiles', options.get('workers')))
+        # options of the requested engine do not carry over to another one
+        options = dict(options, **extra) if planned == engine else extra
+        engine = planned
+    if cache is not None:
+        df = cache.run(params, seed, days, engine, replicate, **options)
+    else:
+        df = engines[engine](params, seed, days, replicate, **options)
+    if isinstance(df, pd.DataFrame):
+        df.attrs['engine'] = engine
+    return df
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.engine import peak_infected
+from clr.streams import BOOTSTRAP, as_streams
+from clr.ensemble import map_runs, run_task
+
+
+# ranges of the model constants: (scale, low, high), 'log' ranges are sampled uniformly in log10,
+# 'int' values are rounded. Paired min/max ranges do not overlap, so every point is a valid model.
+bounds = {
+    'plants_per_cell_min': ('int', 6, 10),
+    'plants_per_cell_max': ('int', 10, 14),
+    'branches_per_plant_min': ('int', 12, 16),
+    'branches_per_plant_max': ('int', 16, 22),
+    'leaves_per_branch_min': ('int', 15, 25),
+    'leaves_per_branch_max': ('int', 25, 35),
+    'age_min': ('int', 0, 50),
+    'age_max': ('int', 200, 300),
+    'berry_cost': ('linear', 50, 90),
+    'leaf_cost': ('linear', 60, 100),
+    'benchmark_1': ('int', 20, 50),
+    'benchmark_2': ('int', 80, 140),
+    'benchmark_3': ('int', 145, 200),
+    'clr_b': ('log', 1e-4, 1e-2),
+    'clr_p': ('log', 1e-5, 1e-3),
+    'clr_g': ('log', 1e-6, 1e-4),
+    'germ_chance': ('linear', 0.1, 1.0),
+    'age_1': ('int', 30, 80),
+    'age_2': ('int', 200, 300),
+    'age_3': ('int', 310, 400),
+}
+
+
+def sobol_outputs(df):
+    """
+    Outputs of one run for the sensitivity analysis: berries and infected leaves per branch
+    on the last day, and the largest share of infected living leaves over the run
+    """
+    last = df[df['time'] == df['time'].max()]
+    return {'berries': float(last['berries'].mean()), 'infected': float(last['infected'].mean()),
+            'peak_infected': peak_infected(df)}
+
+
+def saltelli(n, names, seed=None):
+    """
+    Saltelli design on a scrambled Sobol sequence: matrices A and B (n x d) and, for each
+    parameter i, AB_i (A with column i from B). Returns the points in [0, 1) stacked as
+    A, B, AB_1 ... AB_d, (n * (d + 2)) x d.
+    """
+    from scipy.stats import qmc
+    d = len(names)
+    base = qmc.Sobol(2 * d, scramble=True, seed=as_streams(seed).seed).random(n)
+    A, B = base[:, :d], base[:, d:]
+    blocks = [A, B]
+    for i in range(d):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        blocks.append(AB)
+    return np.vstack(blocks)
+
+
+def _values(u, names, ranges):
+    out = {}
+    for k, x in zip(names, u):
+        kind, lo, hi = ranges[k]
+        if kind == 'log':
+            out[k] = float(10 ** (np.log10(lo) + x * (np.log10(hi) - np.log10(lo))))
+        elif kind == 'int':
+            out[k] = int(np.floor(lo + x * (hi - lo + 1)))
+        else:
+            out[k] = float(lo + x * (hi - lo))
+    return out
+
+
+def _point_key(values):
+    return '|'.join('%s=%r' % kv for kv in sorted(values.items()))
+
+
+def _evaluate(task):
+    *run, output = task
+    return output(run_task(tuple(run)))
+
+
+def _config_key(params, names, seed, days, engine, output):
+    """
+    hash of what decides the outputs of a point besides its constants: the other Params fields,
+    seed, days, engine (and version) and the output function
+    """
+    from clr.cache import run_key
+    base = run_key(params.update(**{k: None for k in names}), seed, days, engine)
+    text = '%s|%s.%s' % (base, output.__module__, output.__qualname__)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _load_checkpoint(path, config):
+    if path is None or not os.path.exists(path):
+        return {}
+    with np.load(path, allow_pickle=False) as f:
+        if 'config' not in f.files or str(f['config']) != config:
+            raise ValueError('checkpoint %s was written for other parameters, seed, days, engine or output, '
+                             'remove it or give another file' % path)
+        keys = [str(k) for k in f['keys']]
+        names = [str(c) for c in f['outputs']]
+        values = f['values']
+    return {k: dict(zip(names, row)) for k, row in zip(keys, values)}
+
+
+def _save_checkpoint(path, done, config):
+    if path is None or not done:
+        return
+    names = list(next(iter(done.values())))
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, config=np.array(config), keys=np.array(list(done), dtype=str), outputs=np.array(names, dtype=str),
+             values=np.array([[done[k][c] for c in names] for k in done], dtype=float))
+    os.replace(tmp, path)
+
+
+def indices(y, n, d, bootstrap=200, confidence=0.95, seed=None):
+    """
+    First-order (Saltelli 2010) and total (Jansen) indices of one output from the evaluations of
+    a saltelli() design, with percentile bootstrap intervals over the n base rows.
+    Returns arrays S1, S1_lo, S1_hi, ST, ST_lo, ST_hi of length d.
+    """
+    fA, fB = y[:n], y[n:2 * n]
+    fAB = y[2 * n:].reshape(d, n)
+
+    def estimate(rows):
+        a, b, ab = fA[rows], fB[rows], fAB[:, rows]
+        var = np.var(np.concatenate([a, b]))
+        if var == 0:
+            return np.zeros(d), np.zeros(d)
+        s1 = np.mean(b * (ab - a), axis=1) / var
+        st = 0.5 * np.mean((a - ab) ** 2, axis=1) / var
+        return s1, st
+
+    s1, st = estimate(np.arange(n))
+    rng = as_streams(seed).generator(BOOTSTRAP)
+    boot = [estimate(rng.integers(0, n, n)) for _ in range(bootstrap)]
+    q = [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100]
+    s1_lo, s1_hi = np.percentile([b[0] for b in boot], q, axis=0)
+    st_lo, st_hi = np.percentile([b[1] for b in boot], q, axis=0)
+    return s1, s1_lo, s1_hi, st, st_lo, st_hi
+
+
+def sobol(params=None, ranges=None, n=64, seed=None, days=None, engine='leaf', output=sobol_outputs, batch=64,
+          workers=None, cache=None, checkpoint=None, bootstrap=200, confidence=0.95):
+    """
+    Variance based sensitivity of the outputs to the model constants in ranges (default: bounds).
+    The n * (d + 2) points of a Saltelli design are evaluated in batches of batch runs through
+    the ensemble worker pool, all with the same seed (common random numbers). Points that give
+    the same constants (rounded integers) are run once, runs can come from a RunCache, and with
+    a checkpoint file the finished points are saved after every batch so an interrupted analysis
+    picks up where it stopped; a checkpoint of other base parameters, seed, days, engine or output
+    is refused. n should be a power of 2.
+    Returns the indices (parameter, output, S1 and ST with their bootstrap intervals) and the
+    evaluated points.
+    """
+    params = Params() if params is None else params
+    ranges = bounds if ranges is None else ranges
+    days = params.days if days is None else days
+    names = list(ranges)
+    seed = as_streams(seed).seed
+    design = saltelli(n, names, seed)
+    points = [_values(u, names, ranges) for u in design]
+    keys = [_point_key(v) for v in points]
+
+    config = _config_key(params, names, seed, days, engine, output)
+    done = _load_checkpoint(checkpoint, config)
+    todo = list(dict.fromkeys(k for k in keys if k not in done))
+    first = {}
+    for k, v in zip(keys, points):
+        first.setdefault(k, v)
+    for start in range(0, len(todo), batch):
+        chunk = todo[start:start + batch]
+        tasks = [(params.update(**first[k]), seed, days, engine, 0, {}, cache, output) for k in chunk]
+        for i, result in map_runs(tasks, fn=_evaluate, workers=workers):
+            done[chunk[i]] = result
+        _save_checkpoint(checkpoint, done, config)
+
+    evaluated = pd.DataFrame(points)
+    results = pd.DataFrame([done[k] for k in keys])
+    rows = []
+    d = len(names)
+    for c in results.columns:
+        s1, s1_lo, s1_hi, st, st_lo, st_hi = indices(results[c].to_numpy(), n, d, bootstrap, confidence, seed)
+        for i, name in enumerate(names):
+            rows.append({'parameter': name, 'output': c, 'S1': s1[i], 'S1_lo': s1_lo[i], 'S1_hi': s1_hi[i],
+                         'ST': st[i], 'ST_lo': st_lo[i], 'ST_hi': st_hi[i]})
+    return pd.DataFrame(rows), pd.concat([evaluated, results], axis=1)
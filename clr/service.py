@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import copy
+import itertools
+import json
+import multiprocessing as mp
+import threading
+import time as timer
+from collections import OrderedDict
+from dataclasses import asdict
+
+from clr.params import Params, param_names, _coerce
+
+
+# built plantations each worker keeps to start runs from
+template_cache = 8
+
+# job states
+QUEUED, RUNNING, DONE, CANCELLED, FAILED = 'queued', 'running', 'done', 'cancelled', 'failed'
+
+
+def _template_key(params, seed, replicate, compact):
+    values = asdict(params)
+    values.pop('days')
+    return json.dumps(values, sort_keys=True, default=str), seed, replicate, compact
+
+
+def _check_value(name, value):
+    """
+    raise ValueError if a (coerced) parameter value does not have the type of its Params field
+    """
+    kind = Params.__dataclass_fields__[name].type
+
+    def leaves(v):
+        return [x for item in v for x in leaves(item)] if isinstance(v, tuple) else [v]
+    if kind is int:
+        ok = isinstance(value, int) and not isinstance(value, bool)
+    elif kind is float:
+        ok = isinstance(value, float)
+    elif kind is tuple:
+        ok = isinstance(value, tuple) and all(isinstance(x, int) and not isinstance(x, bool) for x in leaves(value))
+    else:
+        ok = isinstance(value, dict) and all(isinstance(k, str) and isinstance(v, (int, float))
+                                             and not isinstance(v, bool) for k, v in value.items())
+    if not ok:
+        raise ValueError('parameter %s must be %s, got %s' % (name, kind.__name__, json.dumps(value, default=str)))
+
+
+def _grid_summary(plantation, time):
+    """
+    per grid cell means per branch of the day, as group_frame() gives them
+    """
+    import numpy as np
+    s = plantation.summary()
+    grid = plantation.branches.grid
+    n = len(plantation.cells)
+    count = np.maximum(np.bincount(grid, minlength=n), 1)
+    rows = []
+    for c in range(n):
+        rows.append({'time': time, 'grid': plantation.params.cell_label(plantation.cells[c])})
+    for k in ['healthy', 'dead', 'infected', 'berries']:
+        mean = np.bincount(grid, weights=s[k], minlength=n) / count
+        for c in range(n):
+            rows[c][k] = float(mean[c])
+    return rows
+
+
+def _worker(number, jobs, results, cancel, templates):
+    """
+    Worker process: keeps built plantations for recent (params, seed, replicate) and runs the
+    jobs it is sent day by day, reporting every day's grid summary
+    """
+    from clr.engine import Plantation
+    from clr.streams import Streams
+    cache = OrderedDict()
+
+    def template(params, seed, replicate, compact):
+        key = _template_key(params, seed, replicate, compact)
+        if key not in cache:
+            cache[key] = Plantation.build(params, Streams(seed, replicate), compact=compact)
+            if len(cache) > template_cache:
+                cache.popitem(last=False)
+        cache.move_to_end(key)
+        return copy.deepcopy(cache[key])
+
+    for params, seed, replicate, compact in templates:
+        template(params, seed, replicate, compact)
+    results.put(('ready', number))
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, params, seed, days, replicate, compact = job
+        try:
+            start = timer.perf_counter()
+            plantation = template(params, seed, replicate, compact)
+            streams = Streams(seed, replicate)
+            results.put(('started', job_id, len(plantation.leaves)))
+            for time in range(days):
+                if cancel.value == job_id:
+                    break
+                plantation.step(streams)
+                results.put(('day', job_id, time, _grid_summary(plantation, time), len(plantation.leaves)))
+            else:
+                results.put(('done', job_id, timer.perf_counter() - start))
+                continue
+            results.put(('cancelled', job_id))
+        except Exception as e:
+            results.put(('failed', job_id, repr(e)))
+
+
+class Job:
+    def __init__(self, job_id, params, seed, days, replicate, compact):
+        self.id = job_id
+        self.params = params
+        self.seed = seed
+        self.days = days
+        self.replicate = replicate
+        self.compact = compact
+        self.state = QUEUED
+        self.worker = None
+        self.day = -1
+        self.leaves = 0
+        self.error = None
+        self.submitted = timer.time()
+        self.started = self.finished = None
+        self.summaries = []
+        self.watchers = []
+        self.changed = asyncio.Event()
+
+    def status(self):
+        end = self.finished or timer.time()
+        elapsed = end - self.started if self.started else 0.0
+        return {'id': self.id, 'state': self.state, 'day': self.day + 1, 'days': self.days, 'seed': self.seed,
+                'replicate': self.replicate, 'leaves': self.leaves, 'elapsed': elapsed,
+                'days_per_s': (self.day + 1) / elapsed if elapsed > 0 else 0.0,
+                'queued_s': (self.started or end) - self.submitted, 'error': self.error}
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class JobService:
+    """
+    Local job queue for scenario runs. A pool of worker processes stays warm, with the engine
+    imported and plantations of recent (params, seed, replicate) already built, and runs are
+    dispatched to idle workers in submission order. Every simulated day the worker sends the
+    grid summary (per cell means per branch, as group_frame()) which the service keeps and
+    streams to clients. Queued and running jobs can be cancelled.
+    The HTTP API (TCP or Unix socket) is:
+        POST /jobs                  {"params": {...}, "seed": 1, "days": 250} -> job status
+        GET /jobs, GET /jobs/<id>   status: state, day, elapsed, days_per_s
+        GET /jobs/<id>/stream       the daily grid summaries as JSON lines, until the job ends
+        DELETE /jobs/<id>           cancel
+        GET /stats                  queue length, busy workers and throughput
+    """
+
+    def __init__(self, workers=2, templates=((Params(), 0, 0, False),)):
+        self.n_workers = workers
+        self.templates = list(templates)
+        self.jobs = {}
+        self.queue = []
+        self.ids = itertools.count(1)
+        self.busy = {}
+        self.ready = set()
+        self.started = timer.time()
+        self.days_done = 0
+        self.leaf_days = 0
+        self.server = None
+
+    async def start(self):
+        ctx = mp.get_context()
+        self.loop = asyncio.get_running_loop()
+        self.results = ctx.Queue()
+        self.inboxes = [ctx.Queue() for _ in range(self.n_workers)]
+        self.cancel = [ctx.Value('q', 0) for _ in range(self.n_workers)]
+        self.procs = [ctx.Process(target=_worker, args=(w, self.inboxes[w], self.results, self.cancel[w],
+                                                        self.templates), daemon=True)
+                      for w in range(self.n_workers)]
+        for p in self.procs:
+            p.start()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        while True:
+            msg = self.results.get()
+            if msg is None:
+                return
+            self.loop.call_soon_threadsafe(self._on_message, msg)
+
+    def _on_message(self, msg):
+        kind = msg[0]
+        if kind == 'ready':
+            self.ready.add(msg[1])
+            self._dispatch()
+            return
+        job = self.jobs[msg[1]]
+        if kind == 'started':
+            job.leaves = msg[2]
+        elif kind == 'day':
+            _, _, time, rows, leaves = msg
+            job.day, job.leaves = time, leaves
+            job.summaries.append(rows)
+            self.days_done += 1
+            self.leaf_days += leaves
+        else:
+            job.state = {'done': DONE, 'cancelled': CANCELLED, 'failed': FAILED}[kind]
+            job.error = msg[2] if kind == 'failed' else None
+            job.finished = timer.time()
+            self.busy.pop(job.worker, None)
+            self._dispatch()
+        job.notify()
+
+    def _dispatch(self):
+        idle = [w for w in sorted(self.ready) if w not in self.busy]
+        while idle and self.queue:
+            job = self.jobs[self.queue.pop(0)]
+            w = idle.pop(0)
+            job.state, job.worker, job.started = RUNNING, w, timer.time()
+            self.busy[w] = job.id
+            self.inboxes[w].put((job.id, job.params, job.seed, job.days, job.replicate, job.compact))
+            job.notify()
+
+    def submit(self, spec):
+        """
+        queue a run from {"params": {field: value}, "seed", "days", "replicate", "compact"}
+        """
+        if not isinstance(spec, dict) or not isinstance(spec.get('params', {}), dict):
+            raise ValueError('a job is a JSON object with the parameters as an object')
+        values = spec.get('params', {})
+        unknown = [k for k in values if k not in param_names()]
+        if unknown:
+            raise ValueError('unknown parameter: %s' % ', '.join(unknown))
+        values = {k: _coerce(k, v) for k, v in values.items()}
+        for k, v in values.items():
+            _check_value(k, v)
+        params = Params().update(**values)
+        days = int(spec.get('days', params.days))
+        seed, replicate = int(spec.get('seed', 0)), int(spec.get('replicate', 0))
+        job = Job(next(self.ids), params, seed, days, replicate, bool(spec.get('compact', False)))
+        self.jobs[job.id] = job
+        self.queue.append(job.id)
+        self._dispatch()
+        return job
+
+    def cancel_job(self, job_id):
+        job = self.jobs[job_id]
+        if job.state == QUEUED:
+            self.queue.remove(job_id)
+            job.state, job.finished = CANCELLED, timer.time()
+            job.notify()
+        elif job.state == RUNNING:
+            self.cancel[job.worker].value = job_id
+        return job
+
+    def stats(self):
+        uptime = timer.time() - self.started
+        states = [j.state for j in self.jobs.values()]
+        return {'workers': self.n_workers, 'ready': len(self.ready), 'busy': len(self.busy),
+                'queued': len(self.queue), 'jobs': {s: states.count(s) for s in (QUEUED, RUNNING, DONE, CANCELLED,
+                                                                                  FAILED)},
+                'uptime': uptime, 'days': self.days_done, 'days_per_s': self.days_done / max(uptime, 1e-9),
+                'leaf_days_per_s': self.leaf_days / max(uptime, 1e-9)}
+
+    async def stream(self, job_id):
+        """
+        the job's daily grid summaries, from the first day, until the job has ended
+        """
+        job = self.jobs[job_id]
+        sent = 0
+        while True:
+            changed = job.changed
+            while sent < len(job.summaries):
+                yield job.summaries[sent]
+                sent += 1
+            if job.state in (DONE, CANCELLED, FAILED):
+                return
+            await changed.wait()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            method, path, _ = request.decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, v = line.decode().split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            await self._route(method, path.rstrip('/').split('/')[1:], body, writer)
+        except (ValueError, KeyError, TypeError) as e:
+            self._respond(writer, 400, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            try:
+                await writer.drain()
+                writer.close()
+            except ConnectionError:
+                pass
+
+    async def _route(self, method, parts, body, writer):
+        if parts == ['jobs'] and method == 'POST':
+            self._respond(writer, 201, self.submit(json.loads(body or b'{}')).status())
+        elif parts == ['jobs'] and method == 'GET':
+            self._respond(writer, 200, [j.status() for j in self.jobs.values()])
+        elif parts == ['stats'] and method == 'GET':
+            self._respond(writer, 200, self.stats())
+        elif len(parts) >= 2 and parts[0] == 'jobs' and int(parts[1]) in self.jobs:
+            job_id = int(parts[1])
+            if len(parts) == 2 and method == 'GET':
+                self._respond(writer, 200, self.jobs[job_id].status())
+            elif len(parts) == 2 and method == 'DELETE':
+                self._respond(writer, 200, self.cancel_job(job_id).status())
+            elif parts[2:] == ['stream'] and method == 'GET':
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                             b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+                async for rows in self.stream(job_id):
+                    data = ''.join(json.dumps(r) + '\n' for r in rows).encode()
+                    writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    await writer.drain()
+                writer.write(b'0\r\n\r\n')
+            else:
+                self._respond(writer, 405, {'error': 'method not allowed'})
+        else:
+            self._respond(writer, 404, {'error': 'not found'})
+
+    def _respond(self, writer, code, payload):
+        data = json.dumps(payload).encode()
+        reason = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}[code]
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                     b'Connection: close\r\n\r\n%s' % (code, reason.encode(), len(data), data))
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        """
+        start the workers and answer requests on a TCP port, or on a Unix socket at path
+        """
+        await self.start()
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for w, inbox in enumerate(self.inboxes):
+            if w in self.busy:
+                self.cancel[w].value = self.busy[w]
+            inbox.put(None)
+        for p in self.procs:
+            await asyncio.get_running_loop().run_in_executor(None, p.join, 10)
+            if p.is_alive():
+                p.terminate()
+        self.results.put(None)
+
+
+def serve(host='127.0.0.1', port=8765, path=None, workers=2):
+    """
+    run a JobService until interrupted
+    """
+    async def main():
+        service = JobService(workers)
+        await service.serve(host, port, path)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await service.close()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
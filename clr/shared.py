@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def attach(name):
+    """
+    Attach to an existing shared memory block without taking ownership of it:
+    only the process that created a block unlinks it.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 attaching registers the block with the resource tracker, which would
+    # unlink it when this process exits
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedAlloc:
+    """
+    Column memory in named shared memory blocks owned by this process.
+    Other processes attach to a column by its block name (see name()).
+    """
+
+    def __init__(self):
+        self.blocks = {}
+
+    def zeros(self, size, dtype):
+        dtype = np.dtype(dtype)
+        shm = shared_memory.SharedMemory(create=True, size=max(size * dtype.itemsize, 1))
+        array = np.ndarray(size, dtype=dtype, buffer=shm.buf)
+        array[:] = 0
+        self.blocks[_address(array)] = shm
+        return array
+
+    def name(self, array):
+        return self.blocks[_address(array)].name
+
+    def free(self, array):
+        shm = self.blocks.pop(_address(array), None)
+        if shm is not None:
+            del array
+            _release(shm, unlink=True)
+
+    def close(self):
+        for shm in self.blocks.values():
+            _release(shm, unlink=True)
+        self.blocks = {}
+
+
+class SharedArray:
+    """
+    numpy array in a shared memory block, created here or attached by name
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(create=True, size=size) if self.owner else attach(name)
+        self.name = self.shm.name
+        self.shape, self.dtype = tuple(shape), dtype
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        if self.owner:
+            self.array[...] = 0
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype.str, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], state['dtype'], state['name'])
+
+    def close(self):
+        self.array = None
+        _release(self.shm, unlink=self.owner)
+
+
+def _address(array):
+    return array.__array_interface__['data'][0]
+
+
+def _release(shm, unlink):
+    try:
+        shm.close()
+    except BufferError:
+        # a view on the block is still alive somewhere - the mapping goes with the process
+        pass
+    if unlink:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import json
+import secrets
+import numpy as np
+from multiprocessing import shared_memory
+
+from clr.engine import leaf_columns
+from clr.shared import attach, _release
+
+
+# header rows: 0 = [version, writing, closed], 1 and 2 = [n, time, capacity, generation] of each buffer
+_VERSION, _WRITING, _CLOSED = 0, 1, 2
+_N, _TIME, _CAPACITY, _GENERATION = 0, 1, 2, 3
+
+
+class SnapshotWriter:
+    """
+    Publishes the leaf columns of a running simulation to shared memory once a day.
+    There are two buffers: the day is written to the one readers are not pointed at and
+    then the version is bumped, so the simulation never waits for readers and readers
+    always find a complete day in the front buffer. Call it as plantation monitor
+    (writer(plantation, time)) or use publish() directly.
+    """
+
+    def __init__(self, columns=None, name=None, capacity=1 << 16):
+        self.columns = dict(leaf_columns if columns is None else columns)
+        self.name = 'clr_' + secrets.token_hex(4) if name is None else name
+        spec = json.dumps([[c, np.dtype(d).str] for c, d in self.columns.items()]).encode()
+        self.spec = shared_memory.SharedMemory(name=self.name + '_spec', create=True, size=len(spec) + 8)
+        np.ndarray(1, dtype=np.int64, buffer=self.spec.buf)[0] = len(spec)
+        self.spec.buf[8:8 + len(spec)] = spec
+        self.head_shm = shared_memory.SharedMemory(name=self.name, create=True, size=3 * 4 * 8)
+        self.head = np.ndarray((3, 4), dtype=np.int64, buffer=self.head_shm.buf)
+        self.head[:] = 0
+        self.generation = 0
+        self.capacity = 0
+        self.blocks = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        old = self.blocks
+        self.generation += 1
+        self.capacity = capacity
+        self.blocks = [shared_memory.SharedMemory(name=_block_name(self.name, self.generation, b), create=True,
+                                                  size=max(_row_bytes(self.columns) * capacity, 1))
+                       for b in range(2)]
+        self.buffers = [_columns(self.columns, capacity, shm.buf) for shm in self.blocks]
+        # readers still attached to the old blocks keep their mapping until they move on
+        for shm in old:
+            _release(shm, unlink=True)
+
+    def publish(self, table, time):
+        """
+        Copy the filled part of a Table (e.g. plantation.leaves) as the snapshot of day time
+        """
+        n = len(table)
+        if n > self.capacity:
+            self._allocate(max(n, 2 * self.capacity))
+        version = int(self.head[0, _VERSION]) + 1
+        b = version % 2
+        self.head[0, _WRITING] = version
+        for c, target in self.buffers[b].items():
+            target[:n] = getattr(table, c)
+        self.head[1 + b] = [n, time, self.capacity, self.generation]
+        self.head[0, _VERSION] = version
+
+    def __call__(self, plantation, time):
+        self.publish(plantation.leaves, time)
+
+    def close(self):
+        self.head[0, _CLOSED] = 1
+        self.buffers = []
+        self.head = None
+        for shm in self.blocks + [self.head_shm, self.spec]:
+            _release(shm, unlink=True)
+        self.blocks = []
+
+
+class Snapshot:
+    """
+    One published day: time, number of leaves and the leaf columns.
+    Columns of a zero-copy snapshot point into the shared buffer, valid() tells if the
+    writer has started to overwrite it since.
+    """
+
+    def __init__(self, reader, version, time, n, columns):
+        self.reader = reader
+        self.version = version
+        self.time = time
+        self.n = n
+        self.columns = columns
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def valid(self):
+        return self.reader._intact(self.version)
+
+    def frame(self):
+        import pandas as pd
+        return pd.DataFrame(self.columns)
+
+
+class SnapshotReader:
+    """
+    Attaches to the snapshots of a SnapshotWriter by name, from any process.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        spec = attach(name + '_spec')
+        size = int(np.ndarray(1, dtype=np.int64, buffer=spec.buf)[0])
+        self.columns = {c: np.dtype(d) for c, d in json.loads(bytes(spec.buf[8:8 + size]).decode())}
+        _release(spec, unlink=False)
+        self.head_shm = attach(name)
+        self.head = np.ndarray((3, 4), dtype=np.int64, buffer=self.head_shm.buf)
+        self.generation = 0
+        self.blocks = []
+        self.buffers = []
+
+    @property
+    def version(self):
+        return int(self.head[0, _VERSION])
+
+    @property
+    def closed(self):
+        return bool(self.head[0, _CLOSED])
+
+    def _intact(self, version):
+        # the buffer of a version is only written again for version + 2
+        return int(self.head[0, _WRITING]) < version + 2
+
+    def _buffers(self, generation, capacity):
+        if generation != self.generation:
+            for shm in self.blocks:
+                _release(shm, unlink=False)
+            self.blocks = [attach(_block_name(self.name, generation, b)) for b in range(2)]
+            self.buffers = [_columns(self.columns, capacity, shm.buf) for shm in self.blocks]
+            self.generation = generation
+        return self.buffers
+
+    def view(self, columns=None):
+        """
+        Latest day without copying, or None before the first publish
+        """
+        version = self.version
+        if version == 0:
+            return None
+        b = version % 2
+        n, time, capacity, generation = (int(x) for x in self.head[1 + b])
+        buffer = self._buffers(generation, capacity)[b]
+        names = self.columns if columns is None else columns
+        return Snapshot(self, version, time, n, {c: buffer[c][:n] for c in names})
+
+    def read(self, columns=None, retries=100):
+        """
+        Consistent copy of the latest day, retried if the writer overtook the read
+        """
+        for _ in range(retries):
+            try:
+                snap = self.view(columns)
+            except FileNotFoundError:
+                # the writer grew its buffers between reading the header and attaching
+                continue
+            if snap is None:
+                return None
+            copied = {c: a.copy() for c, a in snap.columns.items()}
+            if snap.valid():
+                return Snapshot(self, snap.version, snap.time, snap.n, copied)
+        raise RuntimeError('snapshot %s kept changing while being read' % self.name)
+
+    def close(self):
+        self.buffers = []
+        self.head = None
+        for shm in self.blocks + [self.head_shm]:
+            _release(shm, unlink=False)
+        self.blocks = []
+
+
+def _block_name(name, generation, buffer):
+    return '%s_g%d_b%d' % (name, generation, buffer)
+
+
+def _row_bytes(columns):
+    return sum(np.dtype(d).itemsize for d in columns.values())
+
+
+def _columns(columns, capacity, buf):
+    """
+    column arrays laid out one after the other in a block
+    """
+    out, offset = {}, 0
+    for c, d in columns.items():
+        d = np.dtype(d)
+        out[c] = np.ndarray(capacity, dtype=d, buffer=buf, offset=offset)
+        offset += capacity * d.itemsize
+    return out
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# days of output per chunk file
+chunk_days = 50
+
+# columns that make up the index of every table
+key_columns = ['scenario', 'replicate', 'time', 'grid']
+
+
+class ResultStore:
+    """
+    The result store keeps model output as typed, compressed binary chunks.
+    Each table is split per scenario and replicate into blocks of chunk_days days,
+    and each block holds one member per grid cell and column. An index over
+    (scenario, replicate, grid, time) decides which members a query has to open,
+    so a single cell's time series or a single day's cross-section only
+    decompresses the data it needs.
+    """
+
+    def __init__(self, path, chunk_days=chunk_days):
+        self.path = path
+        self.chunk_days = chunk_days
+        os.makedirs(path, exist_ok=True)
+        self.index = self._load_index()
+
+    def _index_file(self):
+        return os.path.join(self.path, 'index.npz')
+
+    def _load_index(self):
+        if not os.path.exists(self._index_file()):
+            return pd.DataFrame({'table': pd.Series(dtype=str), 'scenario': pd.Series(dtype=str),
+                                 'replicate': pd.Series(dtype=np.int64), 'grid': pd.Series(dtype=str),
+                                 't0': pd.Series(dtype=np.int64), 't1': pd.Series(dtype=np.int64),
+                                 'rows': pd.Series(dtype=np.int64), 'chunk': pd.Series(dtype=str)})
+        with np.load(self._index_file(), allow_pickle=False) as f:
+            return pd.DataFrame({k: f[k] for k in f.files})
+
+    def _save_index(self):
+        cols = {}
+        for k in self.index.columns:
+            values = self.index[k].to_numpy()
+            cols[k] = values.astype(str) if values.dtype == object else values
+        np.savez_compressed(self._index_file(), **cols)
+
+    def write(self, df, scenario='base', replicate=0, table='branches'):
+        """
+        Write one run's data frame (needs 'time' and 'grid' columns) to the store.
+        Any earlier data for the same table, scenario and replicate is replaced.
+        """
+        scenario = str(scenario)
+        replicate = int(replicate)
+        df = df.reset_index(drop=True)
+        grid_labels = df['grid'].astype(str).to_numpy()
+        time = df['time'].to_numpy()
+        columns = [c for c in df.columns if c != 'grid']
+
+        self.remove(scenario=scenario, replicate=replicate, table=table)
+        folder = os.path.join(self.path, table, scenario)
+        os.makedirs(folder, exist_ok=True)
+
+        entries = []
+        block = time // self.chunk_days
+        for b in np.unique(block):
+            in_block = block == b
+            fname = os.path.join(table, scenario, 'r%05d_t%05d.npz' % (replicate, b * self.chunk_days))
+            members = {}
+            for g in np.unique(grid_labels[in_block]):
+                rows = np.flatnonzero(in_block & (grid_labels == g))
+                for c in columns:
+                    members[_member(g, c)] = _typed(df[c].to_numpy()[rows])
+                entries.append({'table': table, 'scenario': scenario, 'replicate': replicate, 'grid': g,
+                                't0': int(time[rows].min()), 't1': int(time[rows].max()),
+                                'rows': len(rows), 'chunk': fname})
+            np.savez_compressed(os.path.join(self.path, fname), **members)
+
+        new = pd.DataFrame(entries, columns=self.index.columns)
+        self.index = pd.concat([self.index, new], ignore_index=True) if len(self.index) else new
+        self._save_index()
+
+    def remove(self, scenario=None, replicate=None, table='branches'):
+        """
+        Drop the chunks of a table matching the given scenario and/or replicate.
+        """
+        mask = self._select(table, scenario, replicate, None, None)
+        if not mask.any():
+            return
+        for fname in self.index.loc[mask, 'chunk'].unique():
+            fpath = os.path.join(self.path, fname)
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        self.index = self.index[~mask].reset_index(drop=True)
+        self._save_index()
+
+    def _select(self, table, scenario, replicate, grid, time):
+        idx = self.index
+        mask = (idx['table'] == table).to_numpy().copy()
+        if scenario is not None:
+            mask &= np.isin(idx['scenario'].to_numpy(), _as_list(scenario, str))
+        if replicate is not None:
+            mask &= np.isin(idx['replicate'].to_numpy(), _as_list(replicate, int))
+        if grid is not None:
+            mask &= np.isin(idx['grid'].to_numpy(), _as_list(grid, str))
+        if time is not None:
+            lo, hi = _time_range(time)
+            mask &= (idx['t1'].to_numpy() >= lo) & (idx['t0'].to_numpy() <= hi)
+        return mask
+
+    def keys(self, table='branches'):
+        """
+        The (scenario, replicate) pairs stored for a table
+        """
+        idx = self.index[self.index['table'] == table]
+        return sorted(set(zip(idx['scenario'], idx['replicate'].astype(int))))
+
+    def read(self, table='branches', scenario=None, replicate=None, grid=None, time=None, columns=None):
+        """
+        Query a table. scenario, replicate and grid take a single value or a list,
+        time takes a single day or an inclusive (first, last) pair.
+        Only the chunk members that can hold matching rows are opened.
+        """
+        entries = self.index[self._select(table, scenario, replicate, grid, time)]
+        frames = []
+        for fname, group in entries.groupby('chunk', sort=False):
+            with np.load(os.path.join(self.path, fname), allow_pickle=False) as f:
+                for _, e in group.iterrows():
+                    cols = columns
+                    if cols is None:
+                        cols = [m.split('|', 1)[1] for m in f.files if m.split('|', 1)[0] == e['grid']]
+                    data = {c: f[_member(e['grid'], c)] for c in ['time'] + [c for c in cols if c != 'time']}
+                    frame = pd.DataFrame(data)
+                    frame.insert(0, 'grid', e['grid'])
+                    frame.insert(0, 'replicate', int(e['replicate']))
+                    frame.insert(0, 'scenario', e['scenario'])
+                    if time is not None:
+                        lo, hi = _time_range(time)
+                        frame = frame[(frame['time'] >= lo) & (frame['time'] <= hi)]
+                    frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=key_columns + list(columns or []))
+        out = pd.concat(frames, ignore_index=True)
+        ordered = key_columns + [c for c in out.columns if c not in key_columns]
+        if columns is not None:
+            ordered = key_columns + [c for c in columns if c not in key_columns]
+        return out[ordered].sort_values(['scenario', 'replicate', 'time', 'grid'], kind='stable').reset_index(drop=True)
+
+    def cell_series(self, grid, scenario='base', replicate=0, table='branches', columns=None):
+        """
+        All days of one grid cell
+        """
+        return self.read(table=table, scenario=scenario, replicate=replicate, grid=grid, columns=columns)
+
+    def cross_section(self, time, scenario='base', replicate=0, table='branches', columns=None):
+        """
+        All grid cells on one day
+        """
+        return self.read(table=table, scenario=scenario, replicate=replicate, time=time, columns=columns)
+
+
+def _member(grid, column):
+    return '%s|%s' % (grid, column)
+
+
+def _typed(values):
+    """
+    Object columns (strings from the data frame) are stored as fixed width unicode,
+    everything else keeps its numpy dtype.
+    """
+    if values.dtype == object:
+        return values.astype(str)
+    return values
+
+
+def _as_list(value, kind):
+    if isinstance(value, (list, tuple, set, np.ndarray)):
+        return [kind(v) for v in value]
+    return [kind(value)]
+
+
+def _time_range(time):
+    if isinstance(time, (list, tuple)):
+        return int(time[0]), int(time[1])
+    return int(time), int(time)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+# what a stream is used for
+LAYOUT = 0
+DAY = 1
+EVENT = 2
+# parameter proposals of the ABC calibration
+PROPOSAL = 3
+# resamples of the sensitivity indices
+BOOTSTRAP = 4
+
+
+class Streams:
+    """
+    Random number streams derived from one root seed.
+    Every (replicate, grid cell, day) gets its own counter-based (Philox) generator, keyed
+    by its position in the hierarchy rather than by the order draws happen in. A cell
+    therefore sees the same numbers whether the plantation runs in one process or split
+    into tiles, and replicates are independent of each other and of how they are scheduled.
+    """
+
+    def __init__(self, seed=None, replicate=0):
+        # without a seed, draw a root from the OS once so the run can still be repeated
+        self.seed = np.random.SeedSequence().entropy if seed is None else int(seed)
+        self.replicate = int(replicate)
+
+    def generator(self, purpose, cell=0, day=0):
+        ss = np.random.SeedSequence(self.seed, spawn_key=(self.replicate, purpose, int(cell), int(day)))
+        return np.random.Generator(np.random.Philox(ss))
+
+    def layout(self, cell):
+        """
+        stream for building the plants, branches and leaves of a grid cell
+        """
+        return self.generator(LAYOUT, cell)
+
+    def day(self, cell, day):
+        """
+        stream for the draws of a grid cell on a day
+        """
+        return self.generator(DAY, cell, day)
+
+    def event(self, cell, day):
+        """
+        stream for interventions applied to a grid cell on a day
+        """
+        return self.generator(EVENT, cell, day)
+
+    def for_replicate(self, replicate):
+        return Streams(self.seed, replicate)
+
+    def __repr__(self):
+        return 'Streams(seed=%d, replicate=%d)' % (self.seed, self.replicate)
+
+
+def as_streams(seed, replicate=0):
+    """
+    Streams from a seed, or the given Streams unchanged
+    """
+    if isinstance(seed, Streams):
+        return seed
+    return Streams(seed, replicate)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+import time as timer
+import numpy as np
+import pandas as pd
+
+from clr.params import Params
+from clr.engine import Plantation, Recorder, run
+from clr.streams import as_streams
+
+
+# default largest leap (days) and allowed change of the latent leaves per leap
+max_leap = 7
+leap_eps = 0.25
+
+
+class TauLeapPlantation(Plantation):
+    """
+    Plantation that can advance several days in one step (tau-leaping).
+    Infection pressure is frozen at the start of a leap: a healthy leaf exposed to n latent
+    leaves at spread chance p gets infected on a day with chance 1-(1-p*germ_chance)^n
+    (the binomial spore count of Branch.infection followed by germ_rust), so the new
+    infections of a branch over k days are one binomial draw. Spores already on the leaves
+    germinate on the first day and new spores are spread at the end of the leap, as in the
+    daily step, so leaps and daily steps can follow each other. Aging and the benchmark
+    transitions of infected leaves are deterministic and are jumped directly.
+    Leaf and berry production run at the production rate of the first day of the leap, plus that
+    of the leaves grown during the leap.
+    With counts='poisson' the new infections of a branch are a Poisson count (capped at its healthy
+    leaves) with the binomial's mean, the usual tau-leaping approximation for rare infections.
+    """
+
+    counts = 'binomial'
+
+    def hazard(self, exchange=None):
+        """
+        Daily infection chance of a healthy leaf on each branch, and healthy leaves per branch
+        """
+        p = self.params
+        L, B, P = self.leaves, self.branches, self.plants
+        nb = len(B)
+        status = L.status
+        branch_inf = np.bincount(L.branch[status == 1], minlength=nb)
+        plant_inf = np.bincount(B.plant, weights=branch_inf, minlength=len(P)).astype(np.int64)
+        grid_inf = np.bincount(P.grid, weights=plant_inf, minlength=len(self.cells)).astype(np.int64)
+        if exchange is not None:
+            grid_inf = exchange(grid_inf)
+        n_branch = branch_inf
+        n_plant = plant_inf[B.plant] - branch_inf
+        n_grid = grid_inf[B.grid] - plant_inf[B.plant]
+        by_grid = n_grid > 0
+        by_plant = ~by_grid & (n_plant > 0)
+        n = np.where(by_grid, n_grid, np.where(by_plant, n_plant, n_branch))
+        chance = np.where(by_grid, p.clr_g, np.where(by_plant, p.clr_p, p.clr_b))
+        germ = self.varieties.columns['germ_chance'][P.variety[B.plant]]
+        daily = 1 - (1 - chance * germ) ** n
+        healthy = np.bincount(L.branch[status == 0], minlength=nb)
+        return daily, healthy
+
+    def leap_size(self, eps=leap_eps, largest=max_leap):
+        """
+        Largest leap (up to largest days) over which the latent leaves of every grid cell
+        change by at most eps of their number - counting expected new infections and
+        latent leaves that reach benchmark_1 and start to sporulate.
+        """
+        L, B = self.leaves, self.branches
+        n_cells = len(self.cells)
+        daily, healthy = self._hazard = self.hazard()
+        self._hazard_time = self.time
+        rate = np.bincount(B.grid, weights=daily * healthy, minlength=n_cells)
+        latent = L.status == 1
+        latent_cell = np.bincount(L.grid[latent], minlength=n_cells)
+        to_spores = np.clip(self.lp.benchmark_1[latent] - L.idays[latent], 1, largest + 1)
+        leaving = np.bincount(L.grid[latent] * (largest + 2) + to_spores, minlength=n_cells * (largest + 2))
+        leaving = np.cumsum(leaving.reshape(n_cells, largest + 2), axis=1)
+        allowed = eps * np.maximum(latent_cell, 1)
+        for k in range(largest, 1, -1):
+            if np.all(k * rate + leaving[:, k] <= allowed):
+                return k
+        return 1
+
+    def leap(self, streams, k, exchange=None):
+        """
+        Advance the plantation by k days
+        """
+        if k == 1:
+            return self.step(streams, exchange)
+        self._day_streams = {}
+        L, B = self.leaves, self.branches
+        nb = len(B)
+        if exchange is None and getattr(self, '_hazard_time', None) == self.time:
+            daily = self._hazard[0]
+        else:
+            daily = self.hazard(exchange)[0]
+        status = L.status
+
+        # the first day as the daily step: aging and the benchmark transitions, production of the
+        # aged leaves, and spores already on the leaves germinate
+        alive = status < 3
+        L.age[alive] += 1
+        L.idays[(status == 1) | (status == 2)] += 1
+        self._set_status(alive)
+        contrib = self.production()
+        took = self.germ_rust(streams)
+
+        # the other k-1 days, infections from the pressure on the first day
+        candidates = np.flatnonzero(status == 0)
+        branch = L.branch[candidates]
+        healthy = np.bincount(branch, minlength=nb)
+        chance = 1 - (1 - daily) ** (k - 1)
+        if self.counts == 'poisson':
+            mean = healthy * chance
+            n_new = np.minimum(self.per_cell(streams, B.grid, lambda rng, part: rng.poisson(mean[part]), np.int64),
+                               healthy)
+        else:
+            n_new = self.binomial(streams, B.grid, healthy, chance)
+        hit = np.flatnonzero(n_new[branch] > 0)
+        cell = L.grid[candidates[hit]]
+        key = self.per_cell(streams, cell, lambda rng, part: rng.random(len(part)), np.float64)
+        offset = self.per_cell(streams, cell, lambda rng, part: rng.integers(1, k, len(part)), np.int64)
+        order = np.lexsort((key, branch[hit]))
+        first = np.searchsorted(branch[hit][order], np.arange(nb))
+        rank = np.empty(len(hit), dtype=np.int64)
+        rank[order] = np.arange(len(hit)) - first[branch[hit][order]]
+        chosen = rank < n_new[branch[hit]]
+        infected = candidates[hit[chosen]]
+
+        # jump aging and the benchmark transitions of the other k-1 days
+        alive = status < 3
+        L.age[alive] += k - 1
+        L.idays[(status == 1) | (status == 2)] += k - 1
+        L.idays[took] = k
+        status[infected] = 1
+        L.idays[infected] = k - offset[chosen]
+        self._set_status(alive)
+
+        # k days of production at the first day's rate, new leaves day by day as in production_l.
+        # Leaves grown in the leap produce as healthy young leaves (8 on their first day, then 5).
+        p = self.params
+        productivity = self.varieties.columns['productivity'][self.plants.variety[B.plant]]
+        young = np.zeros(nb)
+        for day in range(k):
+            B.leaf_prod[:] += contrib + young
+            new = np.floor(B.leaf_prod / p.leaf_cost).astype(np.int64)
+            grow = np.flatnonzero(new > 0)
+            born = np.zeros(nb)
+            if len(grow):
+                n = new[grow]
+                B.leaf_prod[grow] -= n * n * p.leaf_cost
+                self.add_leaves(np.repeat(grow, n), leaf=np.repeat(B.n_leaves[grow] + n, n), age=k - 1 - day, prod=8)
+                B.n_leaves[grow] += n
+                born[grow] = n
+            B.berry_prod[:] += contrib + young + 0.8 * born * productivity
+            young += 0.5 * born * productivity
+        berries = np.floor(B.berry_prod / p.berry_cost)
+        B.berries[:] += berries.astype(np.int64)
+        B.berry_prod[:] -= berries * p.berry_cost
+
+        # spores for the next day, as at the end of a daily step
+        plant_inf, grid_inf = self.latent_counts(exchange)
+        self.infection(streams, plant_inf, grid_inf)
+        self.time += k
+        if self.log is not None:
+            self.log.record(self)
+
+    def _set_status(self, alive):
+        """
+        status and productivity from age and days infected, as the daily steps leave them
+        """
+        p = self.params
+        L, lp = self.leaves, self.lp
+        status, age, idays, prod = L.status, L.age, L.idays, L.prod
+        a = age[alive]
+        prod[alive] = np.where(a > p.age_2, 7, np.where(a > p.age_1, 10, 5))
+        inf = alive & ((status == 1) | (status == 2))
+        d = idays[inf]
+        penalty = np.where(d < lp.benchmark_1[inf], 2, np.where(d < lp.benchmark_2[inf], 5, 8))
+        prod[inf] = np.maximum(prod[inf], penalty) - penalty
+        status[inf] = np.where(d < lp.benchmark_1[inf], 1, 2)
+        status[alive & ((age >= p.age_3) | (idays >= lp.benchmark_3))] = 3
+
+
+def run_tau(params=None, seed=None, days=None, eps=leap_eps, largest=max_leap, monitor=None, replicate=0, log=None,
+            compact=False, counts='binomial'):
+    """
+    Run with adaptive leaps; days with a leap size of 1 use the daily step. counts is 'binomial' or
+    'poisson', the draw of the new infections of a leap.
+    The branch level data frame has rows only for the last day of each leap, and a log
+    records the transitions of a leap on its last day.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    streams = as_streams(seed, replicate)
+    if counts not in ('binomial', 'poisson'):
+        raise ValueError("counts is 'binomial' or 'poisson', got %r" % counts)
+    plantation = TauLeapPlantation.build(params, streams, compact=compact)
+    plantation.counts = counts
+    if log is not None:
+        log.start(plantation)
+    recorder = Recorder(plantation)
+    while plantation.time < days:
+        k = min(plantation.leap_size(eps, largest), days - plantation.time)
+        plantation.leap(streams, k)
+        recorder.record(plantation.time - 1)
+        if monitor is not None:
+            monitor(plantation, plantation.time - 1)
+    return recorder.frame()
+
+
+class StageCounts:
+    """
+    monitor counting leaves per infection stage each day
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def __call__(self, plantation, time):
+        L = plantation.leaves
+        status = L.status
+        self.rows.append({'time': time, 'healthy': int((status == 0).sum()), 'latent': int((status == 1).sum()),
+                          'spores': int((status == 2).sum()),
+                          'rust_dead': int(((status == 3) & (L.idays >= plantation.lp.benchmark_3)).sum()),
+                          'berries': int(plantation.branches.berries.sum())})
+
+    def frame(self):
+        return pd.DataFrame(self.rows)
+
+
+def leap_error(params=None, seeds=range(20), days=None, eps=leap_eps, largest=max_leap, tolerance=0.1,
+               counts='binomial'):
+    """
+    Check tau-leaping against the daily engine on the same seeds. Leaves are counted per
+    stage - latent (before benchmark_1), sporulating (benchmark_1 to benchmark_3), dead from
+    rust (benchmark_3) - with healthy leaves and berries, and the ensemble means are compared
+    on the days both engines recorded. error is the largest difference of the means relative
+    to the largest daily mean, and a count is ok if it is at most tolerance. noise is the largest
+    3 standard errors of the difference on the same scale: where it is above tolerance the seeds
+    cannot tell an error of that size from chance, and more seeds are needed.
+    Returns the report and the speedup.
+    """
+    params = Params() if params is None else params
+    days = params.days if days is None else days
+    daily, leaped = [], []
+    t_daily = t_tau = 0.0
+    for seed in seeds:
+        stages = StageCounts()
+        start = timer.perf_counter()
+        run(params, seed, days, monitor=stages)
+        t_daily += timer.perf_counter() - start
+        daily.append(stages.frame())
+        stages = StageCounts()
+        start = timer.perf_counter()
+        run_tau(params, seed, days, eps, largest, monitor=stages, counts=counts)
+        t_tau += timer.perf_counter() - start
+        leaped.append(stages.frame())
+    daily, leaped = pd.concat(daily).groupby('time'), pd.concat(leaped).groupby('time')
+    d_mean, d_se = daily.mean(), daily.sem().fillna(0)
+    t_mean, t_se = leaped.mean(), leaped.sem().fillna(0)
+    common = t_mean.index.intersection(d_mean.index)
+    rows = []
+    for c in ['latent', 'spores', 'rust_dead', 'healthy', 'berries']:
+        scale = max(d_mean[c].abs().max(), 1.0)
+        diff = (t_mean.loc[common, c] - d_mean.loc[common, c]).abs()
+        noise = 3 * np.sqrt(t_se.loc[common, c] ** 2 + d_se.loc[common, c] ** 2)
+        rows.append({'count': c, 'daily_max': d_mean[c].max(), 'error': diff.max() / scale,
+                     'noise': noise.max() / scale, 'ok': bool(diff.max() <= tolerance * scale)})
+    return pd.DataFrame(rows), t_daily / max(t_tau, 1e-9)
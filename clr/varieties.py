@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from dataclasses import dataclass
+import numpy as np
+
+
+@dataclass
+class Variety:
+    """
+    Resistance parameters of a coffee cultivar. Values left at None use the model defaults
+    in Params. benchmark_1 is the latency period, the leaf sporulates from benchmark_1
+    until it dies at benchmark_3. productivity scales the leaf's contribution to leaf and berry production.
+    """
+    name: str
+    germ_chance: float = None
+    benchmark_1: int = None
+    benchmark_2: int = None
+    benchmark_3: int = None
+    productivity: float = 1.0
+
+
+# susceptible variety is the model default, resistant values are placeholders until calibrated
+varieties = {
+    'susc': Variety('susc'),
+    'res': Variety('res', germ_chance=0.1, benchmark_1=50, benchmark_2=130, benchmark_3=140, productivity=0.9),
+}
+
+# per-leaf parameter columns resolved from the variety table
+param_columns = {'germ_chance': np.float64, 'benchmark_1': np.int64, 'benchmark_2': np.int64,
+                 'benchmark_3': np.int64, 'productivity': np.float64}
+# the same with narrow benchmarks, chances stay double so results do not change
+compact_param_columns = {'germ_chance': np.float64, 'benchmark_1': np.int16, 'benchmark_2': np.int16,
+                         'benchmark_3': np.int16, 'productivity': np.float64}
+
+
+class VarietyTable:
+    """
+    Parameter table with one row per variety in the plantation mixture.
+    Leaves carry the row number (variety code) and their parameters are looked up
+    by indexing the table columns with the codes, once when the leaves are created.
+    """
+
+    def __init__(self, params, table=None):
+        table = varieties if table is None else table
+        unknown = [v for v in params.mixture if v not in table]
+        if unknown:
+            raise ValueError('unknown variety: %s' % ', '.join(unknown))
+        self.names = list(params.mixture)
+        weights = np.array([params.mixture[v] for v in self.names], dtype=float)
+        self.weights = weights / weights.sum()
+        self.columns = {}
+        for c, dtype in param_columns.items():
+            values = [getattr(table[v], c) for v in self.names]
+            self.columns[c] = np.array([getattr(params, c) if x is None else x for x in values], dtype=dtype)
+
+    def code(self, name):
+        return self.names.index(name)
+
+    def draw(self, rng, size):
+        """
+        variety codes for new plants, following the mixture shares
+        """
+        if len(self.names) == 1:
+            return np.zeros(size, dtype=np.int64)
+        return rng.choice(len(self.names), size=size, p=self.weights)
+
+    def gather(self, codes):
+        """
+        per-leaf parameter arrays for an array of variety codes
+        """
+        return {c: v[codes] for c, v in self.columns.items()}
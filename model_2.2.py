@@ -3,10 +3,8 @@
 from dataclasses import dataclass
 import pandas as pd
 import numpy as np
-import scipy
 import random
 from itertools import chain
-import seaborn as sns
 
 
 # what is the size of a typical smallholder coffee plantation? (how many plants)
@@ -59,6 +57,11 @@ age_1 = 50
 age_2 = 250
 age_3 = 350
 
+# random seed - set to a number for a reproducible run (clr/streams.py for the array engine)
+seed = None
+random.seed(seed)
+np.random.seed(seed)
+
 # make grid
 grid_size = 2
 x = np.arange(0,grid_size)
@@ -375,9 +378,13 @@ df.set_index('id_no',inplace=True,drop=True)
 grouped_tg = df.groupby(['time','grid']).agg({'healthy':'mean','dead':'mean','infected':'mean','berries':'mean'})
 grouped_tg.reset_index(inplace=True,drop=False)
 
-#df.to_csv("branch_level_data.csv",sep=';')
-#grouped_tg.to_csv("grouped_data_for_charts.csv",sep=';')
+# typed binary store, indexed by (scenario, replicate, time, grid) - see clr/store.py
+#from clr import ResultStore
+#store = ResultStore("output/store")
+#store.write(df, scenario='base', replicate=0, table='branches')
+#store.write(grouped_tg, scenario='base', replicate=0, table='grouped')
 
+#import seaborn as sns
 #sns.lineplot(data = grouped_tg,x = grouped_tg.time,y = grouped_tg.berries,hue=grouped_tg.grid)
 #sns.lineplot(data = grouped_tg,x = grouped_tg.time,y = grouped_tg.infected,hue=grouped_tg.grid)
 #sns.lineplot(data = grouped_tg,x = grouped_tg.time,y = grouped_tg.healthy,hue=grouped_tg.grid)